@@ -0,0 +1,83 @@
+"""encode/decode throughput of the User codecs
+
+compares the previous serialisation (dataclasses.asdict + sorted json.dumps)
+against every codec in ovos_user_id.codec, msgpack is skipped if not installed
+
+usage: python benchmarks/bench_codec.py [-n 20000]
+"""
+import argparse
+import json
+import time
+from dataclasses import asdict
+from datetime import datetime
+
+
+def _report(name: str, n: int, encode_s: float, decode_s: float, size: int):
+    print(f"{name:<16} encode {n / encode_s:10.0f} users/s   "
+          f"decode {n / decode_s:10.0f} users/s   {size:5d} bytes")
+
+
+def _user():
+    from ovos_user_id.db import User
+    return User(user_id=42, name="bench", discriminator="user",
+                aliases=["b", "bench user"], auth_phrase="open sesame",
+                voice_embeddings=bytes(192 * 4), city="Lisbon", country="Portugal",
+                timezone="Europe/Lisbon", latitude=38.7, longitude=-9.1,
+                secondary_langs=["en-us", "pt-br"], tts_config={"module": "ovos-tts-plugin-piper"},
+                email="bench@example.com", external_identifiers={"github_id": "bench"})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20000, help="users per run")
+    args = parser.parse_args()
+
+    from ovos_user_id.codec import CODECS, get_codec
+    from ovos_user_id.db import User
+    user = _user()
+
+    # before: deep copy + sorted stdlib json, embeddings hex encoded by hand
+    def old_encode(u):
+        data = asdict(u)
+        data["voice_embeddings"] = data["voice_embeddings"].hex()
+        data["face_embeddings"] = data["face_embeddings"].hex()
+        data["creation_date"] = data["creation_date"].isoformat()
+        return json.dumps(data, sort_keys=True)
+
+    def old_decode(s):
+        data = json.loads(s)
+        data["voice_embeddings"] = bytes.fromhex(data["voice_embeddings"])
+        data["face_embeddings"] = bytes.fromhex(data["face_embeddings"])
+        data["creation_date"] = datetime.fromisoformat(data["creation_date"])
+        return User(**data)
+
+    encoded = old_encode(user)
+    start = time.perf_counter()
+    for _ in range(args.n):
+        old_encode(user)
+    encode_s = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.n):
+        old_decode(encoded)
+    _report("asdict+json", args.n, encode_s, time.perf_counter() - start, len(encoded))
+
+    for name in CODECS:
+        try:
+            codec = get_codec(name)
+        except ImportError as e:
+            print(f"{name:<16} skipped, {e}")
+            continue
+        encoded = codec.encode(user)
+        assert codec.decode(encoded) == user
+        start = time.perf_counter()
+        for _ in range(args.n):
+            codec.encode(user)
+        encode_s = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.n):
+            codec.decode(encoded)
+        _report(name, args.n, encode_s, time.perf_counter() - start, len(encoded))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""import time budget of ovos_user_id
+
+ovos-core loads the "ovos-user-session-manager" metadata transformer at
+startup, importing this package must be fast and must not touch redis
+
+the modules ovos-core has already loaded at that point (plugin manager,
+bus client) are imported first so only this package is measured
+
+usage: python benchmarks/bench_import_time.py [--budget-ms 250]
+exits with status 1 if the budget is exceeded or the import has side effects
+"""
+import argparse
+import subprocess
+import sys
+
+_PROBE = """
+import sys, time
+import ovos_plugin_manager.templates.transformers
+import ovos_bus_client.session
+preloaded = set(sys.modules)
+start = time.perf_counter()
+import ovos_user_id
+elapsed = time.perf_counter() - start
+from ovos_user_id import redis_conn
+from ovos_user_id.users import UserManager, _LazyClassAttribute
+new = set(sys.modules) - preloaded
+print(elapsed * 1000)
+print(int("numpy" in new))
+print(int(redis_conn._client is not None or
+          not isinstance(UserManager.__dict__["db"], _LazyClassAttribute)))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=250)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    timings = []
+    for _ in range(args.runs):
+        # fresh interpreter per run, nothing cached in sys.modules
+        out = subprocess.run([sys.executable, "-c", _PROBE], check=True,
+                             capture_output=True, text=True).stdout.split()
+        elapsed, imported_numpy, connected = float(out[0]), out[1] == "1", out[2] == "1"
+        timings.append(elapsed)
+    best = min(timings)
+    print(f"import ovos_user_id: best {best:.1f} ms, worst {max(timings):.1f} ms "
+          f"(budget {args.budget_ms:.0f} ms)")
+
+    failed = False
+    if best > args.budget_ms:
+        print("FAIL: import time over budget")
+        failed = True
+    if imported_numpy:
+        print("FAIL: numpy imported at import time")
+        failed = True
+    if connected:
+        print("FAIL: redis / UserDB initialized at import time")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
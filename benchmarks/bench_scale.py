@@ -0,0 +1,247 @@
+"""latency of the user database and session injection hot paths as the user count grows
+
+seeds synthetic users (1k, 10k and 100k by default) and measures get_user,
+the find_* lookups, list_users, add_user, UserSessionPlugin.transform and
+UserManager.authenticate, reporting throughput, p50/p99 latency and redis
+round trips per operation (a pipeline or transaction counts as one)
+
+face and voice recognition use stub recognizers, so authenticate measures
+this package (camera/mic reads, prediction cache, auth bookkeeping) and not
+a model
+
+usage: python benchmarks/bench_scale.py [--sizes 1000,10000,100000] [-n 2000]
+                                        [--redis-url redis://127.0.0.1:6379/15]
+                                        [-o results.json] [--compare baseline.json]
+
+fakeredis is used unless --redis-url is given, that database is FLUSHED,
+fakeredis walks the whole keyspace on every SCAN page so list_users grows
+quadratically there, use a redis-server for its numbers or skip it with
+--list-n 0, results are saved as json, --compare prints the p50/p99 change against a
+previous results file
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from datetime import datetime
+
+
+class _StubRecognizer:
+    """predict() answers instantly with the user bound to it"""
+
+    def __init__(self):
+        self.user_id = None
+        self.calls = 0
+
+    def predict(self, data, top_k: int = 3):
+        self.calls += 1
+        return {str(self.user_id): 0.9}
+
+
+def _round_trips() -> float:
+    """redis round trips of this package's clients so far, the pub/sub
+    invalidation listener is not counted"""
+    from ovos_user_id.metrics import METRICS
+    return METRICS.counters.get(("redis_round_trips", ""), 0)
+
+
+def _measure(fn, n: int) -> dict:
+    timings = []
+    before = _round_trips()
+    for i in range(n):
+        start = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - start)
+    round_trips = _round_trips() - before
+    total = sum(timings)
+    timings.sort()
+    return {"n": n,
+            "ops_per_s": n / total if total else 0.0,
+            "mean_us": total / n * 1e6,
+            "p50_us": timings[len(timings) // 2] * 1e6,
+            "p99_us": timings[min(int(len(timings) * 0.99), len(timings) - 1)] * 1e6,
+            "round_trips": round_trips / n}
+
+
+def _report(name: str, stats: dict):
+    print(f"  {name:<28} {stats['ops_per_s']:10.0f} ops/s   p50 {stats['p50_us']:9.1f} us   "
+          f"p99 {stats['p99_us']:9.1f} us   {stats['round_trips']:5.1f} round trips")
+
+
+def _synthetic_user(i: int) -> dict:
+    return {"name": f"user {i}", "discriminator": "user",
+            "aliases": [f"alias {i}"], "auth_phrase": f"phrase {i}",
+            "external_identifiers": {"github_id": f"gh{i}"},
+            "city": "Lisbon", "country": "Portugal", "timezone": "Europe/Lisbon",
+            "latitude": 38.7, "longitude": -9.1, "system_unit": "metric"}
+
+
+def _connect(redis_url):
+    """fresh, empty redis for each user count"""
+    import redis
+    if redis_url:
+        client = redis.Redis.from_url(redis_url)
+        client.flushdb()
+        return client
+    import fakeredis
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+def run_size(size: int, args) -> dict:
+    import numpy as np
+    from ovos_bus_client.session import Session
+    from ovos_user_id import UserSessionPlugin, redis_conn
+    from ovos_user_id.cam import RedisCameraWriter
+    from ovos_user_id.db import UserDB, SESSION_FIELDS
+    from ovos_user_id.mic import MicManager
+    from ovos_user_id.session_map import session_map_from_config
+    from ovos_user_id.users import UserManager
+
+    client = _connect(args.redis_url)
+    redis_conn.set_redis(client)
+    MicManager._readers.clear()
+
+    db = UserDB(r=client)
+    uncached = UserDB(cache_size=0, r=client)
+    results = {}
+
+    start = time.perf_counter()
+    for offset in range(0, size, 1000):
+        db.add_users(_synthetic_user(i) for i in range(offset, min(offset + 1000, size)))
+    elapsed = time.perf_counter() - start
+    results["seed"] = {"n": size, "users_per_s": size / elapsed, "seconds": elapsed}
+    print(f"{size} users, seeded in {elapsed:.1f}s")
+
+    rng = random.Random(size)
+    targets = [rng.randrange(size) for _ in range(args.n)]  # index of the synthetic user
+    user_ids = [t + 1 for t in targets]  # ids are assigned sequentially from 1
+
+    for user_id in user_ids:
+        db.get_user(user_id)  # warm the cache
+    ops = {
+        "get_user": lambda i: db.get_user(user_ids[i]),
+        "get_user (uncached)": lambda i: uncached.get_user(user_ids[i]),
+        "get_user (session fields)": lambda i: uncached.get_user(user_ids[i], fields=SESSION_FIELDS),
+        "find_user": lambda i: db.find_user(f"user {targets[i]}"),
+        "find_user_by_alias": lambda i: db.find_user_by_alias(f"alias {targets[i]}"),
+        "find_by_auth_phrase": lambda i: db.find_by_auth_phrase(f"phrase {targets[i]}"),
+        "find_by_external_id": lambda i: db.find_by_external_id(f"gh{targets[i]}"),
+    }
+    for name, fn in ops.items():
+        results[name] = _measure(fn, args.n)
+        _report(name, results[name])
+
+    if args.list_n:
+        results["list_users"] = _measure(lambda i: db.list_users(), args.list_n)
+        _report("list_users", results["list_users"])
+
+    # session injection, sessions already carrying the user vs first message of a session
+    UserManager.db = db
+    UserManager.sess2user = session_map_from_config(client)
+    plugin = UserSessionPlugin()
+    contexts = []
+    for i in range(100):
+        session_id = f"bench-{i}"
+        UserManager.sess2user[session_id] = user_ids[i]
+        contexts.append(plugin.transform({"session": Session(session_id=session_id).serialize()}))
+
+    def transform(i):
+        contexts[i % 100] = plugin.transform(contexts[i % 100])
+
+    results["transform"] = _measure(transform, args.n)
+    _report("transform", results["transform"])
+
+    def transform_new_session(i):
+        session_id = f"bench-new-{size}-{i}"
+        UserManager.sess2user[session_id] = user_ids[i]
+        plugin.transform({"session": Session(session_id=session_id).serialize()})
+
+    results["transform (new session)"] = _measure(transform_new_session, args.n)
+    _report("transform (new session)", results["transform (new session)"])
+
+    # authentication with stub face/voice recognizers, the frame/audio never changes
+    face, voice = _StubRecognizer(), _StubRecognizer()
+    UserManager.bind(face, voice)
+    RedisCameraWriter("bench", r=client).put(np.zeros((48, 64, 3), dtype=np.uint8))
+    client.set("mic::bench", bytes(16000 * 2))
+
+    def authenticate(i):
+        face.user_id = voice.user_id = user_ids[i]
+        UserManager.authenticate(user_ids[i], "bench", f"phrase {targets[i]}", mic_id="mic::bench")
+
+    def authenticate_new_input(i):
+        UserManager.prediction_cache.clear()
+        authenticate(i)
+
+    results["authenticate"] = _measure(authenticate, args.n)
+    _report("authenticate", results["authenticate"])
+    results["authenticate (new input)"] = _measure(authenticate_new_input, args.n)
+    _report("authenticate (new input)", results["authenticate (new input)"])
+    UserManager.bind(None, None)
+
+    # last, it grows the database
+    results["add_user"] = _measure(lambda i: db.add_user(**_synthetic_user(size + i)), args.n)
+    _report("add_user", results["add_user"])
+
+    db.close()
+    uncached.close()
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    print(f"\nchange vs {baseline.get('version', '?')} ({baseline.get('date', '?')}), "
+          f"ratio > 1 is slower")
+    for size, ops in results["results"].items():
+        old_ops = baseline.get("results", {}).get(size)
+        if not old_ops:
+            continue
+        print(f"{size} users")
+        for name, stats in ops.items():
+            old = old_ops.get(name)
+            if not old or "p50_us" not in stats or "p50_us" not in old:
+                continue
+            print(f"  {name:<28} p50 x{stats['p50_us'] / old['p50_us']:5.2f}   "
+                  f"p99 x{stats['p99_us'] / old['p99_us']:5.2f}   "
+                  f"round trips {old['round_trips']:5.1f} -> {stats['round_trips']:5.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated user counts")
+    parser.add_argument("-n", type=int, default=2000, help="calls per operation")
+    parser.add_argument("--list-n", type=int, default=3, help="list_users calls per size")
+    parser.add_argument("--redis-url", help="redis database to use (it is flushed), default fakeredis")
+    parser.add_argument("-o", "--output", default="bench_scale.json", help="json results file")
+    parser.add_argument("--compare", help="previous json results file")
+    args = parser.parse_args()
+
+    from ovos_user_id.version import VERSION_MAJOR, VERSION_MINOR, VERSION_BUILD, VERSION_ALPHA
+    version = f"{VERSION_MAJOR}.{VERSION_MINOR}.{VERSION_BUILD}"
+    if VERSION_ALPHA:
+        version += f"a{VERSION_ALPHA}"
+
+    # round trips are counted by the metrics registry on the client given to set_redis
+    from ovos_user_id.metrics import METRICS
+    METRICS.enable()
+    results = {"version": version,
+               "date": datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "redis": "redis-server" if args.redis_url else "fakeredis",
+               "n": args.n,
+               "results": {}}
+    for size in (int(s) for s in args.sizes.split(",")):
+        results["results"][str(size)] = run_size(size, args)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
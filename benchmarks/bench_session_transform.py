@@ -0,0 +1,72 @@
+"""per message latency of UserSessionPlugin.transform
+
+compares the full session rewrite (deserialize + assign2session + serialize,
+the behaviour before memoisation) against the memoised transform
+
+usage: python benchmarks/bench_session_transform.py [--fake] [-n 5000]
+
+--fake uses fakeredis instead of the redis server from mycroft.conf
+"""
+import argparse
+import statistics
+import time
+
+
+def _report(name: str, timings: list):
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:<24} mean {statistics.mean(timings) * 1e6:9.1f} us   "
+          f"p50 {statistics.median(timings) * 1e6:9.1f} us   p99 {p99 * 1e6:9.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=5000, help="messages per run")
+    parser.add_argument("--fake", action="store_true", help="use fakeredis")
+    args = parser.parse_args()
+
+    if args.fake:
+        import fakeredis
+        import redis
+        server = fakeredis.FakeServer()
+        redis.Redis = lambda *a, **kw: fakeredis.FakeRedis(server=server)
+
+    from ovos_bus_client.session import Session
+    from ovos_user_id import UserSessionPlugin
+    from ovos_user_id.db import UserDB
+    from ovos_user_id.users import UserManager
+
+    db = UserDB()
+    user = db.add_user("bench", "user", city="Lisbon", timezone="Europe/Lisbon",
+                       latitude=38.7, longitude=-9.1, system_unit="metric")
+    session_id = "bench-session"
+    UserManager.sess2user[session_id] = user.user_id
+
+    # before: full session rewrite and uncached user lookup on every message
+    UserManager.db = UserDB(cache_size=0)
+    context = {"session": Session(session_id=session_id).serialize()}
+    timings = []
+    for _ in range(args.n):
+        start = time.perf_counter()
+        sess = Session.deserialize(context.get("session", {}))
+        sess = UserManager.assign2session(user_id=user.user_id, session_id=sess.session_id)
+        context["session"] = sess.serialize()
+        timings.append(time.perf_counter() - start)
+    _report("full rewrite", timings)
+
+    # after: memoised transform, session already carries the user preferences
+    UserManager.db = db
+    plugin = UserSessionPlugin()
+    context = {"session": Session(session_id=session_id).serialize()}
+    context = plugin.transform(context)
+    timings = []
+    for _ in range(args.n):
+        start = time.perf_counter()
+        context = plugin.transform(context)
+        timings.append(time.perf_counter() - start)
+    _report("memoised transform", timings)
+    db.delete_user(user.user_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
-from typing import Optional
+from typing import Dict, Optional
 
 from ovos_plugin_manager.templates.transformers import MetadataTransformer
 
 from ovos_bus_client.session import Session
+from ovos_user_id.cache import TTLCache
+from ovos_user_id.metrics import METRICS, configure_metrics, timed
 from ovos_user_id.users import UserManager
 
+# session keys written by UserManager.assign2session
+_SESSION_PREF_KEYS = ("location", "system_unit", "time_format", "date_format")
+
 
 class UserSessionPlugin(MetadataTransformer):
     """
@@ -19,26 +24,80 @@ class UserSessionPlugin(MetadataTransformer):
         # vs remote users (eg, sent by hivemind)
         self.ignore_default_session = self.config.get("ignore_default_session", False)
         self.ignore_remote_sessions = self.config.get("ignore_remote_sessions", False)
+        # (session_id, user_id) -> (user generation, serialized preferences applied to that session)
+        # if the incoming session already carries them there is nothing to do,
+        # the ttl bounds staleness if change notifications are not delivered (cache disabled)
+        self._applied = METRICS.register_cache(
+            "session_memo", TTLCache(maxsize=self.config.get("memo_size", 4096),
+                                     ttl=self.config.get("memo_ttl", 300)))
+        # user_id -> generation, bumped by the db listener whenever the user changes
+        self._generations: Dict[str, int] = {}
+        self._db = None  # database the listener is registered with
+
+    def _user_changed(self, user_id: Optional[str]):
+        """UserDB listener, memo entries of a changed user no longer match"""
+        if user_id is None:
+            self._applied.clear()
+        else:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def _watch_db(self):
+        # UserManager.db is created lazily and may be replaced
+        db = UserManager.db
+        if db is not self._db:
+            if self._db is not None:
+                self._db.remove_listener(self._user_changed)
+            db.add_listener(self._user_changed)
+            self._db = db
+            self._applied.clear()
 
+    def bind(self, bus=None):
+        super().bind(bus)
+        # "user_metrics" config, answers ovos.user_id.metrics.get on this bus
+        configure_metrics(self.bus)
+        # face/voice recognition served by ovos-user-recognition if it is running
+        if self.config.get("use_recognition_service", True):
+            UserManager.connect_service(self.bus)
+
+    @timed(name="UserSessionPlugin.transform")
     def transform(self, context: Optional[dict] = None) -> dict:
-        sess = Session.deserialize(context.get("session", {}))
+        session = context.get("session") or {}
+        session_id = session.get("session_id") or Session.deserialize(session).session_id
         if "user_id" not in context:
-            # assign the user_id tied to this session
-            if sess.session_id in UserManager.sess2user:
-                context["user_id"] = UserManager.sess2user[sess.session_id]
+            # assign the user_id tied to this session, a single lookup (one round-trip
+            # for a shared map, no KeyError if the binding expires meanwhile)
+            user_id = UserManager.sess2user.get(session_id)
             # nothing to do
-            else:
+            if user_id is None:
                 return context
+            context["user_id"] = user_id
 
         # (maybe) update the session with user preferences
-        if self.ignore_default_session and sess.session_id == "default":
+        if self.ignore_default_session and session_id == "default":
             # typically user_id was assigned by a user recognition plugin
             return context
-        elif self.ignore_remote_sessions and sess.session_id != "default":
+        elif self.ignore_remote_sessions and session_id != "default":
             # typically user_id was assigned by a hivemind client
             return context
 
-        sess = UserManager.assign2session(user_id=context["user_id"],
-                                          session_id=sess.session_id)
-        context["session"] = sess.serialize()
+        user_id = context["user_id"]
+        self._watch_db()
+        # sqlite only notices writes of other processes (eg. the CLI) when asked
+        self._db.poll_changes()
+        memo_key = (session_id, user_id)
+        generation = self._generations.get(str(user_id), 0)
+        memo = self._applied.get(memo_key)
+        if memo is not None and memo[0] == generation and \
+                all(session.get(k) == v for k, v in memo[1].items()):
+            # user already applied to this session and unchanged since, no db access
+            if UserManager.sess2user.get(session_id) != user_id:
+                UserManager.sess2user[session_id] = user_id
+            return context
+
+        sess = UserManager.assign2session(user_id=user_id,
+                                          session_id=session_id)
+        with METRICS.timer("Session.serialize"):
+            context["session"] = sess.serialize()
+        # generation read before the user, a change meanwhile leaves a stale entry that never matches
+        self._applied.put(memo_key, (generation, {k: context["session"].get(k) for k in _SESSION_PREF_KEYS}))
         return context
@@ -0,0 +1,486 @@
+"""asyncio counterparts of UserDB and UserManager, built on redis.asyncio
+
+same data layout, cache and semantics as the sync classes, meant for async
+consumers (hivemind-core, websocket bridges) that serve many clients from a
+single event loop over one pooled connection
+"""
+import asyncio
+import time
+from typing import Optional, Iterable, List, Union, AsyncIterator, Tuple, Dict, Callable, TYPE_CHECKING
+
+import redis
+from ovos_bus_client.message import Message
+from ovos_bus_client.session import Session
+from ovos_utils.log import LOG
+
+from ovos_user_id.db import User, SESSION_FIELDS, _BINARY_FIELDS, _INVALIDATE_CHANNEL, _ID_COUNTER_KEY, \
+    _ID_SET_KEY, _import_progress_key, _user_key, _queue_add, _queue_index, _queue_update, _queue_delete, \
+    _decode_user, _index_key, _auth_phrase_index_key, _LEGACY_AUTH_PHRASE_INDEX, _REBUILD_PREFIX, \
+    _staged_key, _live_key, _embeddings_key, _check_fields, _invalidation_message, _RedisUserDBBase
+from ovos_user_id.metrics import timed
+from ovos_user_id.redis_conn import get_async_redis
+from ovos_user_id.session_map import LocalSessionUserMap
+from ovos_user_id.users import UserManager, AuthResult, _LazyClassAttribute
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+class AsyncUserDB(_RedisUserDBBase):
+    """asyncio version of UserDB, the redis layout, cache and decoding are
+    shared with it (_RedisUserDBBase), only the commands are awaited
+
+    listeners are called from the event loop"""
+    _cache_name = "user_db_async"
+
+    def __init__(self, cache_size: Optional[int] = None, cache_ttl: Optional[float] = None,
+                 r=None):
+        """Initialize AsyncUserDB, defaults to the shared redis.asyncio connection pool."""
+        super().__init__(cache_size, cache_ttl)
+        self.r = r or get_async_redis()
+        self._listener: Optional[asyncio.Task] = None
+
+    # cache invalidation
+    def _ensure_listener(self):
+        # started on first use, needs a running event loop
+        if self._cache.maxsize > 0 and self._listener is None:
+            self._listener = asyncio.ensure_future(self._listen())
+
+    def add_listener(self, callback: Callable):
+        super().add_listener(callback)
+        self._ensure_listener()  # changes made by other processes are notified too
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self.r.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(_INVALIDATE_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._on_invalidation(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._on_listener_error(e)
+                await asyncio.sleep(1)
+
+    async def invalidate(self, user_id: Optional[int] = None):
+        """drop a user (or everything if user_id is None) from the caches of all processes"""
+        self._invalidate_locally(user_id)
+        await self.r.publish(_INVALIDATE_CHANNEL, _invalidation_message(user_id, self._origin))
+
+    async def close(self):
+        """stop the cache invalidation listener"""
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+
+    # CRUD
+    async def _highest_user_id(self) -> int:
+        """see UserDB._highest_user_id"""
+        highest = 0
+        async for key in self.r.scan_iter("user::*", count=1000):
+            highest = max(highest, self._key_user_id(key) or 0)
+        return highest
+
+    async def _advance_id_counter(self, last_id: int):
+        """see UserDB._advance_id_counter"""
+        async def _advance(pipe):
+            if last_id > int(await pipe.get(_ID_COUNTER_KEY) or 0):
+                pipe.multi()
+                pipe.set(_ID_COUNTER_KEY, last_id)
+
+        await self.r.transaction(_advance, _ID_COUNTER_KEY)
+
+    async def _insert(self, new_users: List[User], progress: Optional[Tuple[str, int]] = None) -> bool:
+        """see UserDB._insert"""
+        keys = [_user_key(u.user_id) for u in new_users]
+        async with self.r.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(*keys)
+                    if await pipe.exists(*keys):
+                        return False
+                    pipe.multi()
+                    self._queue_insert(pipe, new_users, progress)
+                    await pipe.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+
+    async def _add(self, users: List[Dict], progress: Optional[Tuple[str, int]] = None) -> List[User]:
+        """see UserDB._add"""
+        while True:
+            # INCRBY is atomic, concurrent writers always get distinct ids
+            new_users = self._with_ids(users, await self.r.incrby(_ID_COUNTER_KEY, len(users)))
+            if await self._insert(new_users, progress):
+                break
+            LOG.warning("user_id counter behind the stored users, moving it forward")
+            await self._advance_id_counter(await self._highest_user_id())
+        self._invalidated([u.user_id for u in new_users])
+        return new_users
+
+    @timed
+    async def add_user(self, name: str, discriminator: str, **kwargs) -> User:
+        """Add a new user to Redis."""
+        assert discriminator in ["user", "agent", "group", "role"]
+        return (await self._add(self._new_user_records([dict(kwargs, name=name,
+                                                             discriminator=discriminator)])))[0]
+
+    @timed
+    async def add_users(self, users: Iterable[Dict],
+                        progress: Optional[Tuple[str, int]] = None) -> List[User]:
+        """see UserDB.add_users"""
+        users = self._new_user_records(users)
+        if not users:
+            return []
+        return await self._add(users, progress)
+
+    async def import_progress(self, source: str) -> int:
+        """see UserDB.import_progress"""
+        return int(await self.r.get(_import_progress_key(source)) or 0)
+
+    async def clear_import_progress(self, source: str):
+        await self.r.delete(_import_progress_key(source))
+
+    @timed
+    async def update_user(self, user_id: int, **kwargs) -> User:
+        """Update user information in Redis."""
+        _check_fields(kwargs)
+
+        async def _update(pipe) -> User:
+            user, legacy = await self._read_user(pipe, user_id)
+            if not user:
+                raise ValueError("User not found")
+            pipe.multi()
+            # only the modified hash fields are written
+            return _queue_update(pipe, user, legacy, kwargs)
+
+        try:
+            user = await self.r.transaction(_update, _user_key(user_id),
+                                            value_from_callable=True)
+        except redis.RedisError as e:
+            raise ValueError(f"Failed to update user: {str(e)}")
+        await self.invalidate(user_id)
+        return user
+
+    @timed
+    async def delete_user(self, user_id: int):
+        """Delete a user from Redis."""
+
+        async def _delete(pipe):
+            user, _ = await self._read_user(pipe, user_id)
+            pipe.multi()
+            _queue_delete(pipe, user_id, user)
+
+        await self.r.transaction(_delete, _user_key(user_id))
+        await self.invalidate(user_id)
+
+    async def _batch_transaction(self, user_ids: List, queue_writes: Callable):
+        """see UserDB._batch_transaction"""
+        keys = self._keys(user_ids)
+        async with self.r.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(*keys)
+                    found = await self._read_users(keys)
+                    pipe.multi()
+                    result = queue_writes(pipe, found)
+                    self._queue_invalidation(pipe, user_ids)
+                    await pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        self._invalidated(user_ids)
+        return result
+
+    @timed
+    async def update_users(self, updates: Dict[int, Dict]) -> List[User]:
+        """see UserDB.update_users"""
+        user_ids = list(updates)
+        if not user_ids:
+            return []
+        return await self._batch_transaction(user_ids, self._update_writes(user_ids, updates))
+
+    @timed
+    async def delete_users(self, user_ids: Iterable[int]) -> int:
+        """see UserDB.delete_users"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return 0
+        return await self._batch_transaction(user_ids, self._delete_writes(user_ids))
+
+    @classmethod
+    async def _read_user(cls, r, user_id: int):
+        """read a full user, returns (user, is_legacy_json)"""
+        try:
+            return _decode_user(await r.hgetall(_user_key(user_id))), False
+        except redis.ResponseError:  # WRONGTYPE, not yet migrated json string
+            return cls._legacy_user(await r.get(_user_key(user_id)))
+
+    @timed
+    async def get_user(self, user_id: int, fields: Optional[Iterable[str]] = None) -> Optional[User]:
+        """Get a user from Redis by user ID, see UserDB.get_user"""
+        self._ensure_listener()
+        projection = tuple(fields) if fields is not None else None
+        user = self._cached_user(user_id, projection)
+        if user is not None:
+            return user
+
+        epoch = self._cache.epoch
+        try:
+            if projection is None:
+                data = await self.r.hgetall(_user_key(user_id))
+            else:
+                async with self.r.pipeline(transaction=False) as pipe:
+                    fields, binary = self._queue_projection(pipe, user_id, projection)
+                    data = self._projected(fields, binary, await pipe.execute())
+        except redis.ResponseError:  # WRONGTYPE, not yet migrated json string
+            return (await self._read_user(self.r, user_id))[0]
+        return self._cache_user(user_id, projection, data, epoch)
+
+    async def _get_users(self, user_ids: Iterable[Union[int, str, bytes]]) -> List[User]:
+        """fetch several users in a single round-trip"""
+        return await self._fetch(self._keys(user_ids))
+
+    async def _fetch(self, keys: List[Union[str, bytes]], with_embeddings: bool = False) -> List[User]:
+        """pipelined HGETALL of several user keys"""
+        return [user for user, _ in await self._read_users(keys, with_embeddings) if user]
+
+    async def _read_users(self, keys: List[Union[str, bytes]],
+                          with_embeddings: bool = False) -> List[Tuple[Optional[User], bool]]:
+        """(user or None, is_legacy_json) for each user key, in a single round-trip"""
+        if not keys:
+            return []
+        keys = [key.decode("utf-8") if isinstance(key, bytes) else key for key in keys]
+        async with self.r.pipeline(transaction=False) as pipe:
+            self._queue_reads(pipe, keys, with_embeddings)
+            results = await pipe.execute(raise_on_error=False)
+        found = self._decode_reads(keys, results, with_embeddings)
+        for i, (user, legacy) in enumerate(found):
+            if legacy:
+                found[i] = self._legacy_user(await self.r.get(keys[i]))
+        return found
+
+    @timed
+    async def _find(self, index: str, value: str) -> List[User]:
+        """resolve an indexed value into User objects"""
+        return await self._get_users(await self.r.smembers(_index_key(index, value)))
+
+    @timed
+    async def find_user(self, name: str) -> List[User]:
+        """Find users by name."""
+        return await self._find("name", name)
+
+    @timed
+    async def find_by_auth_phrase(self, auth_phrase: str) -> List[User]:
+        """Find users by authentication phrase."""
+        return await self._get_users(await self.r.smembers(_auth_phrase_index_key(auth_phrase)))
+
+    @timed
+    async def find_user_by_alias(self, alias: str) -> List[User]:
+        """Find users by alias."""
+        return await self._find("alias", alias)
+
+    @timed
+    async def find_by_external_id(self, id_string: Union[str, int]) -> List[User]:
+        """Find users by external identifier."""
+        return await self._find("external_id", str(id_string))
+
+    @timed
+    async def find_by_organization(self, organization_id: str) -> List[User]:
+        """Find users by organization."""
+        return await self._find("organization", organization_id)
+
+    async def _scan_pages(self, match: str, count: int) -> AsyncIterator[List]:
+        cursor = 0
+        while True:
+            cursor, keys = await self.r.scan(cursor, match=match, count=count)
+            if keys:
+                yield keys
+            if not cursor:
+                break
+
+    @timed
+    async def rebuild_indexes(self, batch_size: int = 500) -> int:
+        """see UserDB.rebuild_indexes"""
+        async for keys in self._scan_pages(_REBUILD_PREFIX + "*", batch_size):
+            await self.r.delete(*keys)  # left over by an interrupted rebuild
+        last_id = 0
+        n = 0
+        async for keys in self._scan_pages("user::*", batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for user in await self._fetch(keys):
+                _queue_index(pipe, user, _REBUILD_PREFIX)
+                last_id = max(last_id, int(user.user_id))
+                n += 1
+            await pipe.execute()
+        async for keys in self._scan_pages("user_idx::*", batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for key in keys:
+                pipe.exists(_staged_key(key))
+            stale = self._stale_indexes(keys, await pipe.execute())
+            if stale:
+                await self.r.delete(*stale)
+        async for keys in self._scan_pages(_REBUILD_PREFIX + "*", batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for key in keys:
+                pipe.rename(key, _live_key(key))
+            await pipe.execute()
+        if not n:
+            await self.r.delete(_ID_SET_KEY)
+        await self._advance_id_counter(last_id)
+        return n
+
+    async def iter_users(self, batch_size: int = 500, with_embeddings: bool = False) -> AsyncIterator[User]:
+        """see UserDB.iter_users"""
+        async for keys in self._scan_pages("user::*", batch_size):
+            for user in await self._fetch(keys, with_embeddings):
+                yield user
+
+    @timed
+    async def list_users(self) -> List[User]:
+        """List all users stored in Redis."""
+        return [user async for user in self.iter_users()]
+
+    @timed
+    async def get_embeddings(self, user_id: int, kind: str = "face"):
+        """see UserDB.get_embeddings"""
+        assert kind in ["face", "voice"]
+        blob = await self.r.get(_embeddings_key(user_id, kind))
+        inline = None
+        if not blob:
+            # not yet migrated, raw float32 bytes in the user hash
+            try:
+                inline = await self.r.hget(_user_key(user_id), kind + "_embeddings")
+            except redis.ResponseError:  # WRONGTYPE, json string
+                return None
+        return self._decode_embeddings(blob, inline)
+
+    async def iter_embeddings(self, kind: str = "face",
+                              batch_size: int = 500) -> AsyncIterator[Tuple[str, "np.ndarray"]]:
+        """see UserDB.iter_embeddings"""
+        assert kind in ["face", "voice"]
+        async for keys in self._scan_pages(f"user_emb::*::{kind}", batch_size):
+            for entry in self._embeddings_entries(keys, await self.r.mget(keys)):
+                yield entry
+
+    @timed
+    async def migrate(self, batch_size: int = 500) -> int:
+        """see UserDB.migrate"""
+        n = 0
+        async for keys in self._scan_pages("user::*", batch_size):
+            async with self.r.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.type(key)
+                legacy, hashes = self._split_by_type(keys, await pipe.execute())
+            async with self.r.pipeline(transaction=False) as pipe:
+                for key in hashes:
+                    pipe.hmget(key, ["user_id", "revision", *_BINARY_FIELDS])
+                results = await pipe.execute()
+            for key, (uid, rev, *values) in zip(hashes, results):
+                async with self.r.pipeline(transaction=True) as pipe:
+                    if self._queue_inline_migration(pipe, key, uid, rev, values):
+                        await pipe.execute()
+                        n += 1
+            for key in legacy:
+                user, _ = self._legacy_user(await self.r.get(key))
+                if not user:
+                    continue
+                async with self.r.pipeline(transaction=True) as pipe:
+                    pipe.delete(key)
+                    # indexed and counted like a new user, no rebuild_indexes needed
+                    _queue_add(pipe, user)
+                    await pipe.execute()
+                n += 1
+        # databases this old predate the user_id counter
+        await self._advance_id_counter(await self._highest_user_id())
+        async for _ in self.r.scan_iter(_LEGACY_AUTH_PHRASE_INDEX):
+            # plain text auth phrase index keys, replaced by hashed ones
+            await self.rebuild_indexes()
+            break
+        if n:
+            await self.invalidate()
+        return n
+
+    async def count(self) -> int:
+        """Number of users stored in Redis."""
+        return await self.r.scard(_ID_SET_KEY)
+
+
+class AsyncUserManager:
+    """asyncio version of UserManager
+
+    recognizers and session bindings are shared with UserManager,
+    blocking work (device reads, model inference) runs in UserManager.executor
+    """
+    db: AsyncUserDB = _LazyClassAttribute(AsyncUserDB)
+
+    @staticmethod
+    def bind(face_rec, voice_rec):
+        UserManager.bind(face_rec, voice_rec)
+
+    @staticmethod
+    async def from_message(message: Message) -> Optional[User]:
+        uid = message.context.get("user_id", "unknown")
+        if uid == "unknown":
+            return None
+        assert uid.isdigit()  # validate
+        return await AsyncUserManager.db.get_user(int(uid))
+
+    @staticmethod
+    @timed
+    async def assign2session(user_id: int, session_id: str) -> Session:
+        # only the fields injected into the session are retrieved
+        user = (await AsyncUserManager.db.get_user(user_id, fields=SESSION_FIELDS) or
+                AsyncUserManager.db.default_user)
+        sess = UserManager._inject_user(user, session_id)
+        if isinstance(UserManager.sess2user, LocalSessionUserMap):
+            UserManager.sess2user[sess.session_id] = user_id
+        else:
+            # shared maps do network i/o, kept off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, UserManager.sess2user.set,
+                                                             sess.session_id, user_id)
+        LOG.debug(f"assigned user_id: {user_id} to session: {sess.session_id}")
+        return sess
+
+    @staticmethod
+    @timed
+    async def authenticate_detailed(user_id, camera_id, auth_phrase: Optional[str] = None,
+                                    mic_id: Optional[str] = None,
+                                    timeout: Optional[float] = None,
+                                    required_level: Optional[int] = None) -> AuthResult:
+        """see UserManager.authenticate_detailed"""
+        start = time.monotonic()
+        timeout = UserManager.auth_timeout if timeout is None else timeout
+        result = AuthResult(user_id=user_id)
+
+        user = await AsyncUserManager.db.get_user(user_id, fields=("auth_phrase",))
+        if not UserManager._check_phrase(result, user, auth_phrase, start):
+            return result
+
+        loop = asyncio.get_running_loop()
+        deadline = start + timeout
+        checks = UserManager._auth_checks(user_id, camera_id, mic_id, deadline, result, required_level)
+        futures = {loop.run_in_executor(UserManager.executor, UserManager._timed_check, check, *args): factor
+                   for factor, (check, args) in checks.items()}
+        pending = set(futures)
+        while pending and not result.satisfies(required_level):
+            done, pending = await asyncio.wait(pending, timeout=UserManager._remaining(deadline),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break  # deadline reached
+            for fut in done:
+                UserManager._add_check(result, futures[fut], fut.result)
+        return UserManager._finish_auth(result, {fut: futures[fut] for fut in pending},
+                                        required_level, start)
+
+    @staticmethod
+    async def authenticate(user_id, camera_id, auth_phrase: Optional[str] = None,
+                           mic_id: Optional[str] = None,
+                           timeout: Optional[float] = None,
+                           required_level: Optional[int] = None) -> int:
+        """skills should use this to get a auth level, see authenticate_detailed"""
+        result = await AsyncUserManager.authenticate_detailed(user_id, camera_id, auth_phrase, mic_id,
+                                                              timeout, required_level)
+        return result.auth_level
@@ -1,29 +1,170 @@
 import struct
-from typing import Optional
+import time
+from dataclasses import dataclass
+from typing import Optional, Iterator, Any
 from ovos_bus_client.message import Message
-from ovos_config import Configuration
 import redis
-import numpy as np
+
+from ovos_user_id.metrics import METRICS, timed
+from ovos_user_id.redis_conn import get_redis
+
+
+@dataclass
+class CameraFrame:
+    seq: str  # redis stream entry id, increases with every published frame
+    timestamp: float  # unix time the frame was captured
+    image: Any  # numpy array (h, w, 3), uint8
+
+
+def _decode_image(data: bytes, h: int, w: int, encoding: str):
+    import numpy as np  # lazy, keeps package import fast
+    if encoding == "raw":
+        return np.frombuffer(data, dtype=np.uint8).reshape(h, w, 3)
+    try:
+        import cv2
+    except ImportError as e:
+        raise ImportError(f"opencv-python is needed to decode '{encoding}' camera frames") from e
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def _encode_image(image, encoding: str, quality: int = 90) -> bytes:
+    if encoding == "raw":
+        return image.tobytes()
+    try:
+        import cv2
+    except ImportError as e:
+        raise ImportError(f"opencv-python is needed to encode '{encoding}' camera frames") from e
+    if encoding == "jpeg":
+        ok, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    elif encoding == "png":
+        ok, buf = cv2.imencode(".png", image)
+    else:
+        raise ValueError(f"unsupported frame encoding: {encoding}")
+    if not ok:
+        raise ValueError(f"failed to encode frame as {encoding}")
+    return buf.tobytes()
 
 
 class RedisCameraReader:
-    """access camera from https://github.com/OpenVoiceOS/ovos-PHAL-rediscamera"""
-    def __init__(self, device_name: str):
-        # Redis connection
-        kwargs = Configuration().get("redis", {"host": "127.0.0.1", "port": 6379})
-        self.r = redis.Redis(**kwargs)
-        self.r.ping()
+    """access camera from https://github.com/OpenVoiceOS/ovos-PHAL-rediscamera
+
+    get() polls the last frame, the stream methods (wait_for_frame/iter_frames)
+    read the "cam::{device_name}::stream" redis stream and only transfer a frame
+    when a new one was published
+    """
+    def __init__(self, device_name: str, r: Optional[redis.Redis] = None):
+        # Redis connection, defaults to the shared connection pool
+        self.r = r or get_redis()
         self.name = "cam::" + device_name
+        self.stream = self.name + "::stream"
+        # id of the newest frame in the stream, written by RedisCameraWriter
+        self.seq_key = self.name + "::seq"
+        self.last_seq: Optional[str] = None  # last frame returned by wait_for_frame
 
+    @timed
     def get(self):
         """Retrieve Numpy array from Redis camera 'self.name' """
+        import numpy as np  # lazy, keeps package import fast
         encoded = self.r.get(self.name)
+        if encoded is None:
+            return None  # camera not publishing
+        METRICS.add_payload("camera", encoded)
         h, w = struct.unpack('>II', encoded[:8])
         a = np.frombuffer(encoded, dtype=np.uint8, offset=8).reshape(h, w, 3)
         return a
 
+    @staticmethod
+    def _parse_entry(entry_id: bytes, fields: dict) -> CameraFrame:
+        fields = {k.decode("utf-8"): v for k, v in fields.items()}
+        encoding = fields.get("encoding", b"raw").decode("utf-8")
+        METRICS.add_payload("camera", fields["data"])
+        image = _decode_image(fields["data"], int(fields["h"]), int(fields["w"]), encoding)
+        return CameraFrame(seq=entry_id.decode("utf-8"), timestamp=float(fields["ts"]), image=image)
+
+    def latest_seq(self) -> Optional[str]:
+        """id of the newest published frame without transferring it,
+        None if the camera does not publish a stream"""
+        seq = self.r.get(self.seq_key)
+        return seq.decode("utf-8") if isinstance(seq, bytes) else seq
+
+    @timed
+    def get_frame(self, seq: str) -> Optional[CameraFrame]:
+        """the frame with id seq, None if already trimmed from the stream"""
+        entries = self.r.xrange(self.stream, min=seq, max=seq)
+        return self._parse_entry(*entries[0]) if entries else None
+
+    @timed
+    def latest_frame(self) -> Optional[CameraFrame]:
+        """the newest frame in the stream, None if the stream is empty"""
+        entries = self.r.xrevrange(self.stream, count=1)
+        return self._parse_entry(*entries[0]) if entries else None
+
+    def wait_for_frame(self, timeout: Optional[float] = None,
+                       after: Optional[str] = None) -> Optional[CameraFrame]:
+        """return the newest frame published after the frame with id 'after'
+        (defaults to the last frame returned by this reader), waiting up to
+        timeout seconds for one to arrive, None on timeout
+
+        timeout None waits forever"""
+        after = after or self.last_seq
+        if after is None:
+            # first call, the current frame (if any) is new to us
+            entries = self.r.xrevrange(self.stream, count=1)
+        else:
+            # skip over frames we missed, only the newest one is transferred
+            entries = self.r.xrevrange(self.stream, max="+", min="(" + after, count=1)
+        if not entries:
+            block = 0 if timeout is None else max(int(timeout * 1000), 1)
+            res = self.r.xread({self.stream: after or "$"}, count=1, block=block)
+            if not res:
+                return None
+            entries = res[0][1]
+        frame = self._parse_entry(*entries[-1])
+        self.last_seq = frame.seq
+        return frame
+
+    def iter_frames(self, timeout: Optional[float] = None) -> Iterator[CameraFrame]:
+        """yield frames as they are published, stops if no new frame
+        arrives within timeout seconds (None waits forever)"""
+        while True:
+            frame = self.wait_for_frame(timeout)
+            if frame is None:
+                return
+            yield frame
+
+
+class RedisCameraWriter:
+    """publish frames to the "cam::{device_name}::stream" redis stream read by RedisCameraReader
+
+    encoding can be "raw", "jpeg" or "png", compressed encodings need opencv
+    and cut bandwidth considerably for remote satellites
+    """
+    def __init__(self, device_name: str, r: Optional[redis.Redis] = None,
+                 encoding: str = "raw", quality: int = 90, maxlen: int = 2):
+        self.r = r or get_redis()
+        self.stream = "cam::" + device_name + "::stream"
+        self.seq_key = "cam::" + device_name + "::seq"
+        self.encoding = encoding
+        self.quality = quality
+        self.maxlen = maxlen  # frames kept in redis
+
+    def put(self, image, timestamp: Optional[float] = None) -> str:
+        """publish a (h, w, 3) uint8 frame, returns its sequence id"""
+        h, w = image.shape[:2]
+        seq = self.r.xadd(self.stream,
+                          {"ts": timestamp or time.time(), "h": h, "w": w,
+                           "encoding": self.encoding,
+                           "data": _encode_image(image, self.encoding, self.quality)},
+                          maxlen=self.maxlen, approximate=False)
+        # lets readers check for a new frame without downloading it
+        self.r.set(self.seq_key, seq)
+        return seq.decode("utf-8") if isinstance(seq, bytes) else seq
+
 
 class CameraManager:
+    """every get() returns a new reader, each consumer then has its own
+    wait_for_frame cursor (last_seq), readers are cheap and share the redis
+    connection pool"""
 
     @staticmethod
     def from_message(message: Message) -> Optional[RedisCameraReader]:
@@ -32,12 +173,11 @@ class CameraManager:
 
     @staticmethod
     def get(camera_id) -> Optional[RedisCameraReader]:
-        host = Configuration().get("redis", {}).get("host", "127.0.0.1")
-        return RedisCameraReader(camera_id, host)
+        return RedisCameraReader(camera_id)
 
 
 if __name__ == "__main__":
-    remote_cam = RedisCameraReader("laptop", "192.168.1.17")
-    while True:
-        frame = remote_cam.get()
-        # do stuff
\ No newline at end of file
+    remote_cam = RedisCameraReader("laptop")
+    for frame in remote_cam.iter_frames():
+        # do stuff, only new frames are downloaded
+        print(frame.seq, frame.timestamp, frame.image.shape)
@@ -0,0 +1,125 @@
+"""pluggable (de)serialisation of User records, for export/import and transport
+
+every encoded record carries a "schema_version", records written by older
+versions are upgraded by the functions in MIGRATIONS and unknown fields
+(written by newer versions) are ignored
+
+codecs:
+    json     - orjson if installed, stdlib json otherwise, embeddings base64 encoded
+    msgpack  - needs msgpack, embeddings stored as raw bytes
+"""
+import base64
+import json
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Callable, Dict, Union
+
+from ovos_user_id.db import User, SCHEMA_VERSION, _BINARY_FIELDS, _USER_FIELD_SET, _check_new_user, orjson
+
+# schema_version -> function upgrading a record to schema_version + 1
+MIGRATIONS: Dict[int, Callable[[dict], dict]] = {}
+
+
+def to_record(user: User, binary: bool = False) -> dict:
+    """User -> dict of plain values, embeddings are base64 encoded unless binary is set
+
+    shallow, lists and dicts are shared with the User"""
+    record = user.as_dict
+    if isinstance(record["creation_date"], datetime):
+        record["creation_date"] = record["creation_date"].isoformat()
+    for name in _BINARY_FIELDS:
+        value = record[name]  # bytes or numpy array
+        value = value.tobytes() if hasattr(value, "tobytes") else bytes(value or b"")
+        record[name] = value if binary else base64.b64encode(value).decode("utf-8")
+    record["schema_version"] = SCHEMA_VERSION
+    return record
+
+
+def from_record(record: dict) -> User:
+    """dict produced by to_record (any schema version) -> User"""
+    version = record.get("schema_version", 1)
+    while version < SCHEMA_VERSION:
+        record = MIGRATIONS[version](dict(record))
+        version += 1
+    kwargs = {k: v for k, v in record.items() if k in _USER_FIELD_SET}
+    if isinstance(kwargs.get("creation_date"), str):
+        try:
+            kwargs["creation_date"] = datetime.fromisoformat(kwargs["creation_date"])
+        except ValueError:
+            pass  # keep whatever was stored
+    for name in _BINARY_FIELDS:
+        if isinstance(kwargs.get(name), str):  # base64
+            kwargs[name] = base64.b64decode(kwargs[name])
+    _check_new_user(kwargs)  # ValueError instead of a TypeError for incomplete records
+    return User(**kwargs)
+
+
+class UserCodec(ABC):
+    """encodes User objects to bytes and back"""
+    name: str = ""
+    binary: bool = False  # embeddings can be stored as raw bytes
+
+    @abstractmethod
+    def dumps(self, record: dict) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def loads(self, data: Union[str, bytes]) -> dict:
+        raise NotImplementedError
+
+    def encode(self, user: User) -> bytes:
+        return self.dumps(to_record(user, self.binary))
+
+    def decode(self, data: Union[str, bytes]) -> User:
+        return from_record(self.loads(data))
+
+
+class JSONCodec(UserCodec):
+    name = "json"
+
+    def dumps(self, record: dict) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(record, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: Union[str, bytes]) -> dict:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgpackCodec(UserCodec):
+    name = "msgpack"
+    binary = True
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError as e:
+            raise ImportError("msgpack is needed for the msgpack user codec") from e
+        self._msgpack = msgpack
+
+    def dumps(self, record: dict) -> bytes:
+        return self._msgpack.packb(record, use_bin_type=True)
+
+    def loads(self, data: bytes) -> dict:
+        return self._msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+CODECS: Dict[str, type] = {"json": JSONCodec, "msgpack": MsgpackCodec}
+_instances: Dict[str, UserCodec] = {}
+
+
+def register_codec(codec: type):
+    """make a UserCodec subclass available to get_codec under its name"""
+    CODECS[codec.name] = codec
+    _instances.pop(codec.name, None)
+
+
+def get_codec(name: str = "json") -> UserCodec:
+    """shared instance of the codec registered under name"""
+    if name not in _instances:
+        if name not in CODECS:
+            raise ValueError(f"unknown user codec: {name}, available: {list(CODECS)}")
+        _instances[name] = CODECS[name]()
+    return _instances[name]
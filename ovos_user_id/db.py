@@ -1,14 +1,45 @@
+import hashlib
 import json
-from dataclasses import dataclass, field, asdict
+import struct
+import sys
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field, fields
 from datetime import datetime
-from typing import List, Dict, Union, Optional
+from typing import List, Dict, Union, Optional, Set, Iterable, Iterator, Callable, Tuple, TYPE_CHECKING
 
 import redis
 from ovos_config import Configuration
+from ovos_utils.log import LOG
 from ovos_utils.time import now_local
 
+from ovos_user_id.cache import TTLCache
+from ovos_user_id.metrics import METRICS, timed
+from ovos_user_id.redis_conn import get_redis
 
-@dataclass
+if TYPE_CHECKING:
+    import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional, faster json (de)serialisation
+    orjson = None
+
+if orjson is not None:
+    def _dumps(value) -> bytes:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+    _loads = orjson.loads
+else:
+    _dumps = json.dumps
+    _loads = json.loads
+
+# __slots__ make User smaller and attribute access faster, needs python >= 3.10
+_DATACLASS_OPTIONS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**_DATACLASS_OPTIONS)
 class User:
     user_id: int  # this is present in message.context
     name: str
@@ -23,8 +54,9 @@ class User:
 
     # at runtime, this can be used by skills to increase auth_level
     auth_phrase: str = ""  # "voice password" for basic auth in non-sensitive operations
-    voice_embeddings: bytes = b""  # binary data for voice embeddings
-    face_embeddings: bytes = b""  # binary data for face embeddings
+    # binary data for voice/face embeddings, None if the user was read without them (not loaded)
+    voice_embeddings: bytes = b""
+    face_embeddings: bytes = b""
     voice_samples: List[str] = field(default_factory=list)  # folder with audio files
     face_samples: List[str] = field(default_factory=list)  # folder with image files
 
@@ -57,35 +89,374 @@ class User:
     # external_identifiers - eg, facebook_id, github_id... allow mapping users to other dbs
     external_identifiers: Dict = field(default_factory=dict)
 
+    # incremented on every update, allows consumers to detect changes cheaply
+    revision: int = 0
+
     @staticmethod
     def from_dict(user: dict) -> 'User':
-        """Create a User object from a dictionary."""
-        return User(**user)
+        """Create a User object from a dictionary, see ovos_user_id.codec"""
+        from ovos_user_id.codec import from_record
+        return from_record(user)
 
     @staticmethod
-    def from_json(user: str) -> 'User':
+    def from_json(user: Union[str, bytes]) -> 'User':
         """Create a User object from a JSON string."""
-        return User.from_dict(json.loads(user))
+        from ovos_user_id.codec import get_codec
+        return get_codec("json").decode(user)
+
+    def __getitem__(self, item: str):
+        """dict style access, eg. user["name"]"""
+        return getattr(self, item)
+
+    def get(self, item: str, default=None):
+        """dict style access, eg. user.get("name")"""
+        return getattr(self, item, default)
 
     @property
     def as_dict(self) -> dict:
-        """Convert User object to a dictionary."""
-        return asdict(self)
+        """Convert User object to a dictionary.
+
+        shallow, lists and dicts are shared with the User, copy before modifying"""
+        return {name: getattr(self, name) for name in USER_FIELDS}
 
     @property
     def as_json(self) -> str:
-        """Convert User object to a JSON string."""
-        return json.dumps(self.as_dict, sort_keys=True)
+        """Convert User object to a JSON string.
+
+        meant for display and export, embeddings are base64 encoded,
+        UserDB stores them as raw binary instead"""
+        from ovos_user_id.codec import get_codec
+        return get_codec("json").encode(self).decode("utf-8")
+
+
+USER_FIELDS = tuple(f.name for f in fields(User))
+_USER_FIELD_SET = frozenset(USER_FIELDS)  # constant time membership tests
+# field groups, get_user can be asked for a subset of fields
+# so hot paths only transfer and decode what they need
+LOCATION_FIELDS = ("site_id", "city", "city_code", "region", "region_code",
+                   "country", "country_code", "timezone", "latitude", "longitude")
+PREFERENCE_FIELDS = ("system_unit", "time_format", "date_format", "lang",
+                     "secondary_langs", "tts_config", "stt_config")
+BIOMETRIC_FIELDS = ("voice_embeddings", "face_embeddings", "voice_samples", "face_samples")
+# fields used by UserManager.assign2session
+SESSION_FIELDS = LOCATION_FIELDS + ("system_unit", "time_format", "date_format")
+# version of the stored/serialised user layout, bumped on incompatible changes
+SCHEMA_VERSION = 1
+# pub/sub channel used to invalidate the in-process caches of every UserDB
+_INVALIDATE_CHANNEL = "user_db::invalidate"
+# fields needed to construct a User object, always included in projections
+# (creation_date avoids a now_local() call for every projected User)
+_REQUIRED_FIELDS = ("user_id", "name", "discriminator", "creation_date")
+# stored in dedicated binary keys, the user hash only holds a reference
+_BINARY_FIELDS = ("voice_embeddings", "face_embeddings")
+# embeddings binary format: magic, format version, dtype code, ndim, then ndim uint32 dims
+_EMB_MAGIC = b"OVEM"
+_EMB_HEADER = struct.Struct("<4sBBBx")
+_EMB_DTYPES = {0: "float32", 1: "uint8"}
+
+
+def _invalidation_message(user_id: Union[int, str, None], origin: str) -> str:
+    """pub/sub payload, "<user_id or *>|<id of the publishing UserDB>" """
+    return f"{'*' if user_id is None else user_id}|{origin}"
+
+
+def _parse_invalidation(data: Union[str, bytes]) -> Tuple[Optional[str], str]:
+    """pub/sub payload -> (user_id or None for everything, origin),
+    origin is empty for messages published by older versions"""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    user_id, _, origin = data.partition("|")
+    return (None if user_id == "*" else user_id), origin
+
+
+def _user_key(user_id: Union[int, str]) -> str:
+    """key of the redis hash holding a user, one hash field per User field"""
+    return "user::" + str(user_id)
+
+
+def _embeddings_key(user_id: Union[int, str], name: str) -> str:
+    """key of the binary blob holding the voice/face embeddings of a user"""
+    return f"user_emb::{user_id}::{name.split('_')[0]}"
+
+
+def pack_embeddings(embeddings) -> bytes:
+    """numpy array (or raw float32 bytes) -> binary blob with a dtype/shape header"""
+    import numpy as np  # lazy, keeps package import fast
+    if isinstance(embeddings, (bytes, bytearray, memoryview)):
+        # opaque bytes that can not be float32 are kept as is
+        a = np.frombuffer(embeddings, dtype=np.float32 if len(embeddings) % 4 == 0 else np.uint8)
+    else:
+        a = np.ascontiguousarray(embeddings, dtype=np.float32)
+    dtype = 0 if a.dtype == np.float32 else 1
+    return (_EMB_HEADER.pack(_EMB_MAGIC, 1, dtype, a.ndim) +
+            struct.pack(f"<{a.ndim}I", *a.shape) + a.tobytes())
+
+
+def unpack_embeddings(data: bytes):
+    """binary blob -> read-only numpy array, a view over data (no copy)"""
+    import numpy as np  # lazy, keeps package import fast
+    magic, version, dtype, ndim = _EMB_HEADER.unpack_from(data)
+    if magic != _EMB_MAGIC:
+        raise ValueError("not an embeddings blob")
+    shape = struct.unpack_from(f"<{ndim}I", data, _EMB_HEADER.size)
+    offset = _EMB_HEADER.size + 4 * ndim
+    return np.frombuffer(data, dtype=_EMB_DTYPES[dtype], offset=offset).reshape(shape)
+
+
+def _embeddings_payload(data: bytes) -> bytes:
+    """binary blob -> raw float32 bytes, as exposed in User.voice_embeddings/face_embeddings"""
+    ndim = _EMB_HEADER.unpack_from(data)[3]
+    return data[_EMB_HEADER.size + 4 * ndim:]
+
+
+def _is_embeddings_ref(value: bytes) -> bool:
+    # refs are json, anything else is raw bytes stored in the hash by older versions
+    return value == b"null" or value.startswith(b'{"key"')
+
+
+def _encode_value(name: str, value) -> Union[str, bytes]:
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return _dumps(value)
+
+
+def _encode_user(user: User, field_names: Optional[Iterable[str]] = None) -> Dict[str, Union[str, bytes]]:
+    """User -> redis hash mapping, embeddings excluded (see _queue_write)"""
+    return {name: _encode_value(name, getattr(user, name))
+            for name in (field_names or USER_FIELDS) if name not in _BINARY_FIELDS}
+
+
+def _queue_write(pipe, user: User, field_names: Optional[Iterable[str]] = None):
+    """queue the writes of a user (or some of its fields) in a redis pipeline
+
+    embeddings go to their own binary keys, the user hash only stores
+    a reference and version so profile reads stay small"""
+    mapping = _encode_user(user, field_names)
+    if field_names is None:
+        # full writes record the layout version, see ovos_user_id.codec
+        mapping["schema_version"] = SCHEMA_VERSION
+    field_names = field_names or USER_FIELDS
+    for name in _BINARY_FIELDS:
+        if name in field_names:
+            mapping[name] = _queue_embeddings(pipe, user.user_id, name,
+                                              getattr(user, name), user.revision)
+    pipe.hset(_user_key(user.user_id), mapping=mapping)
+
+
+def _queue_embeddings(pipe, user_id: Union[int, str], name: str, data, version: int) -> str:
+    """queue the write (or deletion if empty) of an embeddings blob,
+    returns the reference to store in the user hash"""
+    key = _embeddings_key(user_id, name)
+    if data is not None and len(data):
+        pipe.set(key, pack_embeddings(data))
+        return _dumps({"key": key, "version": version})
+    pipe.delete(key)
+    return _dumps(None)
+
+
+@timed(name="db.decode")
+def _decode_fields(data: Dict) -> Dict:
+    """redis hash mapping (possibly a subset of fields) -> User kwargs"""
+    kwargs = {}
+    for name, value in data.items():
+        if isinstance(name, bytes):
+            name = name.decode("utf-8")
+        if value is None or name not in _USER_FIELD_SET:
+            continue
+        if name in _BINARY_FIELDS:
+            # a reference means the blob was not loaded, None tells updates to leave it alone
+            kwargs[name] = None if _is_embeddings_ref(value) else value
+        else:
+            kwargs[name] = _loads(value)
+    if isinstance(kwargs.get("creation_date"), str):
+        try:
+            kwargs["creation_date"] = datetime.fromisoformat(kwargs["creation_date"])
+        except ValueError:
+            pass  # keep whatever was stored
+    return kwargs
+
+
+def _with_embeddings(data: Dict, names: List[str], blobs: List[Optional[bytes]]) -> Dict:
+    """replace the embeddings references of a user hash mapping with the raw float32 bytes"""
+    for name, blob in zip(names, blobs):
+        if blob:
+            data[name] = _embeddings_payload(blob)
+    return data
+
+
+def _user_from_fields(kwargs: Dict) -> User:
+    """User kwargs -> User, containers are copied so the kwargs can be safely cached"""
+    return User(**{k: v.copy() if isinstance(v, (list, dict)) else v
+                   for k, v in kwargs.items()})
+
+
+def _decode_user(data: Dict) -> Optional[User]:
+    """redis hash mapping (possibly a subset of fields) -> User"""
+    kwargs = _decode_fields(data)
+    return User(**kwargs) if kwargs else None
+
+
+# user_id allocation counter, never decremented so ids are not reused
+_ID_COUNTER_KEY = "user_meta::last_id"
+# set of all stored user_ids, SCARD gives a constant time count
+_ID_SET_KEY = "user_meta::ids"
+
+
+def _import_progress_key(source: str) -> str:
+    """records of source already imported, written with each imported batch"""
+    return "user_meta::import_progress::" + source
+
+
+def _index_key(index: str, value: str) -> str:
+    """key of the redis set holding the user_ids matching an indexed value"""
+    return f"user_idx::{index}::{value}"
+
+
+def _auth_phrase_index_key(auth_phrase: str) -> str:
+    """auth phrases are secrets, their index key holds a sha256 digest so the
+    phrase never shows up in key names (SCAN, MONITOR, keyspace notifications)"""
+    return _index_key("auth_phrase_sha256", hashlib.sha256(auth_phrase.encode("utf-8")).hexdigest())
+
+
+# index keys of older versions, holding the auth phrase in plain text
+_LEGACY_AUTH_PHRASE_INDEX = "user_idx::auth_phrase::*"
+# rebuild_indexes writes the new indexes and id set under this prefix, then renames them over the live keys
+_REBUILD_PREFIX = "user_rebuild::"
+
 
+def _staged_key(key: Union[str, bytes]) -> str:
+    """key rebuild_indexes writes in place of a live key"""
+    return _REBUILD_PREFIX + (key.decode("utf-8") if isinstance(key, bytes) else key)
+
+
+def _live_key(staged: Union[str, bytes]) -> str:
+    """live key replaced by a staged key"""
+    if isinstance(staged, bytes):
+        staged = staged.decode("utf-8")
+    return staged[len(_REBUILD_PREFIX):]
+
+
+def _check_fields(values: Dict):
+    """reject values of the wrong type for indexed fields (eg. json text
+    instead of a list) before anything is written"""
+    if not isinstance(values.get("aliases", []), (list, tuple)):
+        raise ValueError(f"aliases must be a list, got {type(values['aliases']).__name__}")
+    if not isinstance(values.get("external_identifiers", {}), dict):
+        raise ValueError(f"external_identifiers must be a dict, "
+                         f"got {type(values['external_identifiers']).__name__}")
+
+
+def _check_new_user(values: Dict):
+    """fill in the default discriminator and reject records that can not
+    become a User, before any id is reserved"""
+    values.setdefault("discriminator", "user")
+    if values["discriminator"] not in ("user", "agent", "group", "role"):
+        raise ValueError(f"invalid discriminator: {values['discriminator']}")
+    if "name" not in values:
+        raise ValueError("user has no name")
+    unknown = set(values) - _USER_FIELD_SET
+    if unknown:
+        raise ValueError(f"unknown user fields: {sorted(unknown)}")
+    _check_fields(values)
+
+
+def _index_keys(user: User) -> Set[str]:
+    """all secondary index keys a user should be a member of"""
+    _check_fields({"aliases": user.aliases, "external_identifiers": user.external_identifiers})
+    keys = {_index_key("name", user.name)}
+    if user.auth_phrase:
+        keys.add(_auth_phrase_index_key(user.auth_phrase))
+    for alias in user.aliases:
+        keys.add(_index_key("alias", alias))
+    for ext_id in user.external_identifiers.values():
+        keys.add(_index_key("external_id", str(ext_id)))
+    if user.organization_id:
+        keys.add(_index_key("organization", user.organization_id))
+    return keys
+
+
+def _queue_index(pipe, user: User, prefix: str = ""):
+    """queue adding a user to the id set and its secondary indexes"""
+    pipe.sadd(prefix + _ID_SET_KEY, user.user_id)
+    for key in _index_keys(user):
+        pipe.sadd(prefix + key, user.user_id)
+
+
+def _queue_add(pipe, user: User):
+    """queue the writes creating a new user (hash, embeddings, id set, indexes)"""
+    _queue_write(pipe, user)
+    _queue_index(pipe, user)
+
+
+def _updated_fields(changes: Dict) -> List[str]:
+    """fields an update writes, embeddings that were not loaded (None) are skipped"""
+    return [k for k, v in changes.items()
+            if k in _USER_FIELD_SET and k not in ("user_id", "revision")
+            and not (v is None and k in _BINARY_FIELDS)]
+
+
+def _queue_update(pipe, user: User, legacy: bool, changes: Dict) -> User:
+    """apply changes to user and queue the writes, only the modified hash
+    fields and index memberships are written
+
+    embeddings set to None (not loaded) are left untouched, b"" deletes them"""
+    updated = _updated_fields(changes)
+    old_keys = _index_keys(user)
+    for key in updated:
+        setattr(user, key, changes[key])
+    user.revision += 1
+    new_keys = _index_keys(user)
+    if legacy:
+        # convert the old json string into a hash
+        pipe.delete(_user_key(user.user_id))
+        _queue_write(pipe, user)
+    else:
+        _queue_write(pipe, user, updated + ["revision"])
+    for key in old_keys - new_keys:
+        pipe.srem(key, user.user_id)
+    for key in new_keys - old_keys:
+        pipe.sadd(key, user.user_id)
+    return user
+
+
+def _queue_delete(pipe, user_id: Union[int, str], user: Optional[User]):
+    """queue the removal of a user, its embeddings and index memberships"""
+    pipe.delete(_user_key(user_id),
+                *(_embeddings_key(user_id, name) for name in _BINARY_FIELDS))
+    pipe.srem(_ID_SET_KEY, user_id)
+    if user:
+        for key in _index_keys(user):
+            pipe.srem(key, user_id)
+
+
+class BaseUserDB(ABC):
+    """storage backend interface of the user database
+
+    UserDB stores users in redis, SQLiteUserDB (ovos_user_id.sqlite_db) in a
+    local file, user_db_from_config creates the one selected in mycroft.conf
+    """
 
-class UserDB:
-    """Class for managing user data in Redis."""
     def __init__(self):
-        """Initialize UserDB with Redis connection."""
-        # Redis connection
-        kwargs = Configuration().get("redis", {"host": "127.0.0.1", "port": 6379})
-        self.r = redis.Redis(**kwargs)
-        self.r.ping()
+        # called with the user_id (None for everything) whenever users change
+        self._listeners: List[Callable] = []
+
+    def _notify(self, user_id: Optional[str]):
+        for listener in self._listeners:
+            try:
+                listener(user_id)
+            except Exception as e:
+                LOG.error(f"UserDB listener error: {e}")
+
+    def add_listener(self, callback: Callable):
+        """callback(user_id) is called whenever a user is added, updated or deleted,
+        by this or any other process, user_id is None if all users may have changed
+
+        see the backend for how changes made by other processes are detected"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
 
     @property
     def default_user(self) -> User:
@@ -114,89 +485,770 @@ class UserDB:
             email=cfg.get("microservices", {}).get("email", {}).get("recipient", "")
         )
 
+    # CRUD
+    @abstractmethod
+    def add_user(self, name: str, discriminator: str, **kwargs) -> User:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_users(self, users: Iterable[Dict],
+                  progress: Optional[Tuple[str, int]] = None) -> List[User]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_user(self, user_id: int, **kwargs) -> User:
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_users(self, updates: Dict[int, Dict]) -> List[User]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_user(self, user_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_users(self, user_ids: Iterable[int]) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user(self, user_id: int, fields: Optional[Iterable[str]] = None) -> Optional[User]:
+        raise NotImplementedError
+
+    # lookups
+    @abstractmethod
+    def find_user(self, name: str) -> List[User]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_by_auth_phrase(self, auth_phrase: str) -> List[User]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_user_by_alias(self, alias: str) -> List[User]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_by_external_id(self, id_string: Union[str, int]) -> List[User]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_by_organization(self, organization_id: str) -> List[User]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_users(self, batch_size: int = 500, with_embeddings: bool = False) -> Iterator[User]:
+        raise NotImplementedError
+
+    @timed
+    def list_users(self) -> List[User]:
+        """List all users."""
+        return list(self.iter_users())
+
+    @abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    # biometrics
+    @abstractmethod
+    def get_embeddings(self, user_id: int, kind: str = "face"):
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_embeddings(self, kind: str = "face",
+                        batch_size: int = 500) -> Iterator[Tuple[str, "np.ndarray"]]:
+        raise NotImplementedError
+
+    # maintenance
+    @abstractmethod
+    def rebuild_indexes(self) -> int:
+        raise NotImplementedError
+
+    # bulk imports
+    @abstractmethod
+    def import_progress(self, source: str) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear_import_progress(self, source: str):
+        raise NotImplementedError
+
+    def migrate(self, batch_size: int = 500) -> int:
+        return 0
+
+    def invalidate(self, user_id: Optional[int] = None):
+        self._notify(None if user_id is None else str(user_id))
+
+    def poll_changes(self):
+        """notify listeners of changes made by other processes that are only
+        noticed on read, a no-op for backends that push them (redis pub/sub)"""
+
+    @property
+    def cache_stats(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+class _RedisUserDBBase(BaseUserDB):
+    """redis layout, user cache and decoding of replies shared by UserDB and
+    AsyncUserDB (ovos_user_id.aio), the subclasses only send the commands
+
+    get_user is served from a bounded in-process LRU/TTL cache, entries are
+    invalidated via redis pub/sub whenever any process modifies a user,
+    listeners learn about changes made by other processes the same way
+    (only if the cache is enabled)
+    """
+    _cache_name = "user_db"  # reported by METRICS
+
+    def __init__(self, cache_size: Optional[int] = None, cache_ttl: Optional[float] = None):
+        super().__init__()
+        db_cfg = Configuration().get("user_db", {})
+        if cache_size is None:
+            cache_size = db_cfg.get("cache_size", 1024)
+        if cache_ttl is None:
+            cache_ttl = db_cfg.get("cache_ttl", 300)
+        # keys are (user_id, projection), projection is None for full users
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        if cache_size > 0:
+            METRICS.register_cache(self._cache_name, self._cache)
+        self._projections: Set = {None}
+        # tags our own invalidations, their listeners were notified when publishing
+        self._origin = uuid.uuid4().hex
+
+    # cache invalidation
+    def _on_invalidation(self, data: Union[str, bytes]):
+        """pub/sub invalidation published by any process"""
+        user_id, origin = _parse_invalidation(data)
+        if origin == self._origin:
+            return  # published by this instance, already handled locally
+        self._invalidate_locally(user_id)
+
+    def _on_listener_error(self, e: Exception):
+        # invalidations may have been missed while disconnected
+        LOG.warning(f"{type(self).__name__} invalidation listener error, clearing cache: {e}")
+        self._invalidate_locally(None)
+
+    def _invalidate_locally(self, user_id: Union[int, str, None]):
+        """drop a user (or everything if user_id is None) from this cache and notify the listeners"""
+        if user_id is None:
+            self._cache.clear()
+        else:
+            for projection in list(self._projections):
+                self._cache.invalidate((str(user_id), projection))
+        self._notify(None if user_id is None else str(user_id))
+
+    def _queue_invalidation(self, pipe, user_ids: Iterable):
+        """publish the invalidation of several users as part of a transaction"""
+        for user_id in user_ids:
+            pipe.publish(_INVALIDATE_CHANNEL, _invalidation_message(user_id, self._origin))
+
+    def _invalidated(self, user_ids: Iterable):
+        """local side of _queue_invalidation, once the transaction succeeded"""
+        for user_id in user_ids:
+            self._invalidate_locally(user_id)
+
+    @property
+    def cache_stats(self) -> dict:
+        """hit/miss counters of the user cache"""
+        return self._cache.stats
+
+    # reads
+    def _cached_user(self, user_id, projection: Optional[tuple]) -> Optional[User]:
+        cached = self._cache.get((str(user_id), projection))
+        return _user_from_fields(cached) if cached is not None else None
+
+    def _cache_user(self, user_id, projection: Optional[tuple], data: dict, epoch: int) -> Optional[User]:
+        """decode a user hash (or projection) and cache it, epoch was read
+        before the request so a concurrent invalidation is not overwritten"""
+        kwargs = _decode_fields(data)
+        if not kwargs:
+            return None
+        self._projections.add(projection)
+        self._cache.put((str(user_id), projection), kwargs, epoch=epoch)
+        return _user_from_fields(kwargs)
+
+    @staticmethod
+    def _queue_projection(pipe, user_id, projection: tuple) -> Tuple[List[str], List[str]]:
+        """HMGET of the projected fields, embeddings blobs are fetched in the same
+        round-trip, returns the (fields, binary fields) requested"""
+        fields = list(_REQUIRED_FIELDS) + [f for f in projection if f not in _REQUIRED_FIELDS]
+        binary = [f for f in projection if f in _BINARY_FIELDS]
+        pipe.hmget(_user_key(user_id), fields)
+        for name in binary:
+            pipe.get(_embeddings_key(user_id, name))
+        return fields, binary
+
+    @staticmethod
+    def _projected(fields: List[str], binary: List[str], replies: List) -> dict:
+        values, *blobs = replies
+        return _with_embeddings(dict(zip(fields, values)), binary, blobs)
+
+    @staticmethod
+    def _keys(user_ids: Iterable[Union[int, str, bytes]]) -> List[str]:
+        return [_user_key(uid.decode() if isinstance(uid, bytes) else uid) for uid in user_ids]
+
+    @staticmethod
+    def _queue_reads(pipe, keys: List[str], with_embeddings: bool):
+        for key in keys:
+            pipe.hgetall(key)
+            if with_embeddings:
+                for name in _BINARY_FIELDS:
+                    pipe.get(_embeddings_key(key.split("::", 1)[1], name))
+
+    @staticmethod
+    def _decode_reads(keys: List[str], results: List,
+                      with_embeddings: bool) -> List[Tuple[Optional[User], bool]]:
+        """replies of _queue_reads -> (user or None, is_legacy_json) for each key,
+        legacy json strings (WRONGTYPE) are (None, True) and still have to be read with GET"""
+        step = 1 + len(_BINARY_FIELDS) if with_embeddings else 1
+        found = []
+        for i, key in enumerate(keys):
+            data = results[i * step]
+            if isinstance(data, redis.ResponseError):
+                found.append((None, True))
+            elif data:
+                if with_embeddings:
+                    data = _with_embeddings(data, [n.encode("utf-8") for n in _BINARY_FIELDS],
+                                            results[i * step + 1:(i + 1) * step])
+                found.append((_decode_user(data), False))
+            else:
+                found.append((None, False))
+        return found
+
+    @staticmethod
+    def _legacy_user(data) -> Tuple[Optional[User], bool]:
+        """user stored as a json string by older versions, see migrate"""
+        return (User.from_json(data) if data else None), True
+
+    # writes
+    @staticmethod
+    def _new_user_records(users: Iterable[Dict]) -> List[Dict]:
+        """add_users input without the fields assigned by the database,
+        validated before any id is reserved"""
+        users = [{k: v for k, v in u.items() if k not in ("user_id", "revision")}
+                 for u in users]
+        for u in users:
+            _check_new_user(u)  # no id is used up by invalid users
+        return users
+
+    @staticmethod
+    def _with_ids(users: List[Dict], last_id: int) -> List[User]:
+        """users with the ids reserved by INCRBY, last_id is its reply"""
+        return [User(**dict(u, user_id=last_id - len(users) + i + 1))
+                for i, u in enumerate(users)]
+
+    def _queue_insert(self, pipe, new_users: List[User], progress: Optional[Tuple[str, int]]):
+        for user in new_users:
+            _queue_add(pipe, user)
+        if progress:
+            pipe.set(_import_progress_key(progress[0]), progress[1])
+        self._queue_invalidation(pipe, [u.user_id for u in new_users])
+
+    @staticmethod
+    def _update_writes(user_ids: List, updates: Dict[int, Dict]) -> Callable:
+        """queue_writes of update_users, see _batch_transaction"""
+        for changes in updates.values():
+            _check_fields(changes)
+
+        def _update(pipe, found) -> List[User]:
+            missing = [uid for uid, (user, _) in zip(user_ids, found) if not user]
+            if missing:
+                raise ValueError(f"Users not found: {missing}")
+            return [_queue_update(pipe, user, legacy, updates[uid])
+                    for uid, (user, legacy) in zip(user_ids, found)]
+
+        return _update
+
+    @staticmethod
+    def _delete_writes(user_ids: List) -> Callable:
+        """queue_writes of delete_users, see _batch_transaction"""
+        def _delete(pipe, found) -> int:
+            for uid, (user, _) in zip(user_ids, found):
+                _queue_delete(pipe, uid, user)
+            return sum(1 for user, _ in found if user)
+
+        return _delete
+
+    # maintenance
+    @staticmethod
+    def _key_user_id(key: Union[str, bytes]) -> Optional[int]:
+        """user_id of a user::<id> key, None for keys not written by this package"""
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        try:
+            return int(key.split("::", 1)[1])
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _stale_indexes(keys: List, rebuilt: List) -> List:
+        """index keys without a rebuilt counterpart, see rebuild_indexes"""
+        return [key for key, exists in zip(keys, rebuilt) if not exists]
+
+    @staticmethod
+    def _embeddings_entries(keys: List, blobs: List) -> Iterator[Tuple[str, "np.ndarray"]]:
+        """(user_id, array) for each user_emb::<id>::<kind> key and its MGET reply"""
+        for key, blob in zip(keys, blobs):
+            if not blob:
+                continue  # deleted in the meantime
+            if isinstance(key, bytes):
+                key = key.decode("utf-8")
+            yield key.split("::")[1], unpack_embeddings(blob)
+
+    @staticmethod
+    def _decode_embeddings(blob: Optional[bytes], inline: Optional[bytes]):
+        """get_embeddings result from the binary key or, if not yet migrated,
+        the raw float32 bytes stored in the user hash"""
+        METRICS.add_payload("embeddings", blob)
+        if blob:
+            return unpack_embeddings(blob)
+        if inline and not _is_embeddings_ref(inline):
+            return unpack_embeddings(pack_embeddings(inline))
+        return None
+
+    @staticmethod
+    def _split_by_type(keys: List, types: List) -> Tuple[List, List]:
+        """(legacy json string keys, hash keys) of the user keys of a SCAN page"""
+        legacy = [key for key, t in zip(keys, types) if t in (b"string", "string")]
+        hashes = [key for key, t in zip(keys, types) if t in (b"hash", "hash")]
+        return legacy, hashes
+
+    @staticmethod
+    def _queue_inline_migration(pipe, key, uid, rev, values: List) -> bool:
+        """move embeddings stored inside a user hash to their binary keys,
+        values are HMGET replies of _BINARY_FIELDS, returns False if there is nothing to move"""
+        inline = {name: value for name, value in zip(_BINARY_FIELDS, values)
+                  if value is not None and not _is_embeddings_ref(value)}
+        if not uid or not inline:
+            return False
+        uid, rev = _loads(uid), _loads(rev or "0")
+        pipe.hset(key, mapping={name: _queue_embeddings(pipe, uid, name, value, rev)
+                                for name, value in inline.items()})
+        return True
+
+
+class UserDB(_RedisUserDBBase):
+    """Class for managing user data in Redis.
+
+    Lookups by name, alias, auth phrase, external identifier and organization are resolved
+    via secondary indexes (one redis set of user_ids per value) that are kept
+    in sync by add_user/update_user/delete_user inside MULTI/EXEC transactions
+
+    get_user is served from a bounded in-process LRU/TTL cache, entries are
+    invalidated via redis pub/sub whenever any process modifies a user,
+    listeners learn about changes made by other processes the same way
+    (only if the cache is enabled)
+    """
+    def __init__(self, cache_size: Optional[int] = None, cache_ttl: Optional[float] = None,
+                 r: Optional[redis.Redis] = None):
+        """Initialize UserDB with Redis connection, defaults to the shared connection pool."""
+        super().__init__(cache_size, cache_ttl)
+        self.r = r or get_redis()
+        self._pubsub = None
+        self._pubsub_thread = None
+        if self._cache.maxsize > 0:
+            self._pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{_INVALIDATE_CHANNEL: self._handle_invalidation})
+            self._pubsub_thread = self._pubsub.run_in_thread(
+                sleep_time=1, daemon=True,
+                exception_handler=self._handle_pubsub_error)
+
+    def _handle_invalidation(self, message: dict):
+        self._on_invalidation(message["data"])
+
+    def _handle_pubsub_error(self, e: Exception, pubsub, thread):
+        self._on_listener_error(e)
+        time.sleep(1)
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """drop a user (or everything if user_id is None) from the caches of all processes"""
+        self._invalidate_locally(user_id)
+        self.r.publish(_INVALIDATE_CHANNEL, _invalidation_message(user_id, self._origin))
+
+    def close(self):
+        """stop the cache invalidation listener"""
+        if self._pubsub_thread:
+            # the worker thread closes the pubsub connection on exit
+            self._pubsub_thread.stop()
+            self._pubsub_thread.join(timeout=2)
+            self._pubsub_thread = None
+            self._pubsub = None
+
+    def _highest_user_id(self) -> int:
+        """largest user_id stored, found by scanning the user keys"""
+        ids = (self._key_user_id(key) for key in self.r.scan_iter("user::*", count=1000))
+        return max((uid for uid in ids if uid is not None), default=0)
+
+    def _advance_id_counter(self, last_id: int):
+        """move the id counter to last_id unless it is already past it,
+        deleted ids must never be handed out again"""
+        def _advance(pipe):
+            if last_id > int(pipe.get(_ID_COUNTER_KEY) or 0):
+                pipe.multi()
+                pipe.set(_ID_COUNTER_KEY, last_id)
+
+        self.r.transaction(_advance, _ID_COUNTER_KEY)
+
+    def _insert(self, new_users: List[User], progress: Optional[Tuple[str, int]] = None) -> bool:
+        """write users with freshly reserved ids (and the import progress) in a
+        single transaction, returns False without writing anything if any of the ids is taken"""
+        keys = [_user_key(u.user_id) for u in new_users]
+        with self.r.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(*keys)
+                    if pipe.exists(*keys):
+                        return False
+                    pipe.multi()
+                    self._queue_insert(pipe, new_users, progress)
+                    pipe.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+
+    def _add(self, users: List[Dict], progress: Optional[Tuple[str, int]] = None) -> List[User]:
+        """reserve ids for users (dicts of User fields, see _new_user_records) and write them
+
+        databases created before the id counter existed already hold users,
+        the counter is then moved past them and the ids reserved again"""
+        while True:
+            # INCRBY is atomic, concurrent writers always get distinct ids
+            new_users = self._with_ids(users, self.r.incrby(_ID_COUNTER_KEY, len(users)))
+            if self._insert(new_users, progress):
+                break
+            LOG.warning("user_id counter behind the stored users, moving it forward")
+            self._advance_id_counter(self._highest_user_id())
+        self._invalidated([u.user_id for u in new_users])
+        return new_users
+
+    @timed
     def add_user(self, name: str, discriminator: str, **kwargs) -> User:
         """Add a new user to Redis."""
         assert discriminator in ["user", "agent", "group", "role"]
+        return self._add(self._new_user_records([dict(kwargs, name=name, discriminator=discriminator)]))[0]
+
+    @timed
+    def add_users(self, users: Iterable[Dict],
+                  progress: Optional[Tuple[str, int]] = None) -> List[User]:
+        """Add several users, each given as a dict of User fields (user_id is ignored).
+
+        four round-trips in total: a single INCRBY reserves the ids, the new
+        keys are checked to be free (WATCH, EXISTS) and a single transaction
+        writes every user
+
+        progress (source, records done) is stored in the same transaction,
+        an interrupted import resumes from import_progress(source) without
+        adding a batch twice"""
+        users = self._new_user_records(users)
+        if not users:
+            return []
+        return self._add(users, progress)
+
+    def import_progress(self, source: str) -> int:
+        """records of source imported so far, see add_users"""
+        return int(self.r.get(_import_progress_key(source)) or 0)
 
-        new_user = User(user_id=self.count() + 1, name=name, discriminator=discriminator, **kwargs)
-        self.r.set("user::" + str(new_user.user_id), new_user.as_json)
-        print("Added user:", new_user.name, new_user.user_id)
-        return new_user
+    def clear_import_progress(self, source: str):
+        self.r.delete(_import_progress_key(source))
 
+    @timed
     def update_user(self, user_id: int, **kwargs) -> User:
         """Update user information in Redis."""
-        try:
-            user = self.get_user(user_id)
+        _check_fields(kwargs)
+
+        def _update(pipe) -> User:
+            # pipe is in immediate mode until multi() is called,
+            # the transaction is retried if the user is modified meanwhile
+            user, legacy = self._read_user(pipe, user_id)
             if not user:
                 raise ValueError("User not found")
+            pipe.multi()
+            # only the modified hash fields are written
+            return _queue_update(pipe, user, legacy, kwargs)
 
-            # Update fields from kwargs
-            for key, value in kwargs.items():
-                if hasattr(user, key):
-                    setattr(user, key, value)
-
-            self.r.set("user::" + str(user.user_id), user.as_json)
-
-            return user
-        except Exception as e:
+        try:
+            user = self.r.transaction(_update, _user_key(user_id),
+                                      value_from_callable=True)
+        except redis.RedisError as e:
             raise ValueError(f"Failed to update user: {str(e)}")
+        self.invalidate(user_id)
+        return user
 
+    @timed
     def delete_user(self, user_id: int):
         """Delete a user from Redis."""
-        self.r.delete("user::" + str(user_id))
 
-    def get_user(self, user_id: int) -> Optional[User]:
-        """Get a user from Redis by user ID."""
-        user: str = self.r.get("user::" + str(user_id))
-        if user:
-            return User.from_json(user)
-        else:
-            return None
+        def _delete(pipe):
+            user, _ = self._read_user(pipe, user_id)
+            pipe.multi()
+            _queue_delete(pipe, user_id, user)
 
+        self.r.transaction(_delete, _user_key(user_id))
+        self.invalidate(user_id)
+
+    def _batch_transaction(self, user_ids: List, queue_writes: Callable):
+        """run queue_writes(pipe, [(user, is_legacy_json), ...]) in a transaction
+        over several users, in three round-trips (WATCH, read, MULTI/EXEC)
+
+        the users are read through another connection, WATCH still aborts the
+        transaction (and it is retried) if any of them is modified meanwhile"""
+        keys = self._keys(user_ids)
+        with self.r.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(*keys)
+                    found = self._read_users(keys)
+                    pipe.multi()
+                    result = queue_writes(pipe, found)
+                    self._queue_invalidation(pipe, user_ids)
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        self._invalidated(user_ids)
+        return result
+
+    @timed
+    def update_users(self, updates: Dict[int, Dict]) -> List[User]:
+        """Update several users, updates maps user_id -> {field: value}.
+
+        all or nothing, raises ValueError if any user does not exist"""
+        user_ids = list(updates)
+        if not user_ids:
+            return []
+        return self._batch_transaction(user_ids, self._update_writes(user_ids, updates))
+
+    @timed
+    def delete_users(self, user_ids: Iterable[int]) -> int:
+        """Delete several users, returns how many existed"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return 0
+        return self._batch_transaction(user_ids, self._delete_writes(user_ids))
+
+    @classmethod
+    def _read_user(cls, r, user_id: int):
+        """read a full user, returns (user, is_legacy_json)"""
+        try:
+            return _decode_user(r.hgetall(_user_key(user_id))), False
+        except redis.ResponseError:  # WRONGTYPE, not yet migrated json string
+            return cls._legacy_user(r.get(_user_key(user_id)))
+
+    @timed
+    def get_user(self, user_id: int, fields: Optional[Iterable[str]] = None) -> Optional[User]:
+        """Get a user from Redis by user ID.
+
+        if fields is given only those fields are retrieved from Redis (HMGET),
+        the remaining fields of the returned User keep their default values
+
+        embeddings are stored apart from the profile and only loaded when
+        explicitly requested in fields, see also get_embeddings"""
+        projection = tuple(fields) if fields is not None else None
+        user = self._cached_user(user_id, projection)
+        if user is not None:
+            return user
+
+        epoch = self._cache.epoch
+        try:
+            if projection is None:
+                data = self.r.hgetall(_user_key(user_id))
+            else:
+                pipe = self.r.pipeline(transaction=False)
+                fields, binary = self._queue_projection(pipe, user_id, projection)
+                data = self._projected(fields, binary, pipe.execute())
+        except redis.ResponseError:  # WRONGTYPE, not yet migrated json string
+            return self._read_user(self.r, user_id)[0]
+        return self._cache_user(user_id, projection, data, epoch)
+
+    def _get_users(self, user_ids: Iterable[Union[int, str, bytes]]) -> List[User]:
+        """fetch several users in a single round-trip"""
+        return self._fetch(self._keys(user_ids))
+
+    def _fetch(self, keys: List[Union[str, bytes]], with_embeddings: bool = False) -> List[User]:
+        """pipelined HGETALL of several user keys"""
+        return [user for user, _ in self._read_users(keys, with_embeddings) if user]
+
+    def _read_users(self, keys: List[Union[str, bytes]],
+                    with_embeddings: bool = False) -> List[Tuple[Optional[User], bool]]:
+        """(user or None, is_legacy_json) for each user key, in a single round-trip"""
+        if not keys:
+            return []
+        keys = [key.decode("utf-8") if isinstance(key, bytes) else key for key in keys]
+        pipe = self.r.pipeline(transaction=False)
+        self._queue_reads(pipe, keys, with_embeddings)
+        found = self._decode_reads(keys, pipe.execute(raise_on_error=False), with_embeddings)
+        for i, (user, legacy) in enumerate(found):
+            if legacy:
+                found[i] = self._legacy_user(self.r.get(keys[i]))
+        return found
+
+    @timed
+    def _find(self, index: str, value: str) -> List[User]:
+        """resolve an indexed value into User objects"""
+        return self._get_users(self.r.smembers(_index_key(index, value)))
+
+    @timed
     def find_user(self, name: str) -> List[User]:
         """Find users by name."""
-        users = []
-        for key in self.r.scan_iter("user::*"):
-            user: str = self.r.get(key)
-            if user and json.loads(user)['name'] == name:
-                users.append(User.from_json(user))
-        return users
+        return self._find("name", name)
 
+    @timed
     def find_by_auth_phrase(self, auth_phrase: str) -> List[User]:
         """Find users by authentication phrase."""
-        users = []
-        for key in self.r.scan_iter("user::*"):
-            user: str = self.r.get(key)
-            if user and json.loads(user)['auth_phrase'] == auth_phrase:
-                users.append(User.from_json(user))
-        return users
+        return self._get_users(self.r.smembers(_auth_phrase_index_key(auth_phrase)))
 
+    @timed
     def find_user_by_alias(self, alias: str) -> List[User]:
         """Find users by alias."""
-        users = []
-        for key in self.r.scan_iter("user::*"):
-            user: str = self.r.get(key)
-            if user and alias in json.loads(user)['aliases']:
-                users.append(User.from_json(user))
-        return users
+        return self._find("alias", alias)
 
+    @timed
     def find_by_external_id(self, id_string: Union[str, int]) -> List[User]:
         """Find users by external identifier."""
-        users = []
-        for key in self.r.scan_iter("user::*"):
-            user: str = self.r.get(key)
-            if user and str(id_string) in json.loads(user)['external_identifiers'].values():
-                users.append(User.from_json(user))
-        return users
+        return self._find("external_id", str(id_string))
 
-    def list_users(self) -> List[User]:
-        """List all users stored in Redis."""
-        users = []
-        for key in self.r.scan_iter("user::*"):
-            user: str = self.r.get(key)
-            if user:
-                users.append(User.from_json(user))
-        return users
+    @timed
+    def find_by_organization(self, organization_id: str) -> List[User]:
+        """Find users by organization."""
+        return self._find("organization", organization_id)
+
+    def _scan_pages(self, match: str, count: int) -> Iterator[List]:
+        cursor = 0
+        while True:
+            cursor, keys = self.r.scan(cursor, match=match, count=count)
+            if keys:
+                yield keys
+            if not cursor:
+                break
+
+    @timed
+    def rebuild_indexes(self, batch_size: int = 500) -> int:
+        """(re)create the secondary indexes, the user_id set and the id counter
+        from the stored users, needed for databases created before indexes were introduced
+
+        the new keys are written one SCAN page at a time under _REBUILD_PREFIX
+        and renamed over the live ones at the end, client memory and the time
+        redis is blocked by a single request are bounded by batch_size
+
+        returns the number of indexed users"""
+        for keys in self._scan_pages(_REBUILD_PREFIX + "*", batch_size):
+            self.r.delete(*keys)  # left over by an interrupted rebuild
+        last_id = 0
+        n = 0
+        for keys in self._scan_pages("user::*", batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for user in self._fetch(keys):
+                _queue_index(pipe, user, _REBUILD_PREFIX)
+                last_id = max(last_id, int(user.user_id))
+                n += 1
+            pipe.execute()
+        # values no user holds anymore have no rebuilt key, they are dropped
+        for keys in self._scan_pages("user_idx::*", batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for key in keys:
+                pipe.exists(_staged_key(key))
+            stale = self._stale_indexes(keys, pipe.execute())
+            if stale:
+                self.r.delete(*stale)
+        # RENAME replaces each live key atomically, lookups never see a missing index
+        for keys in self._scan_pages(_REBUILD_PREFIX + "*", batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for key in keys:
+                pipe.rename(key, _live_key(key))
+            pipe.execute()
+        if not n:
+            self.r.delete(_ID_SET_KEY)
+        self._advance_id_counter(last_id)
+        return n
+
+    def iter_users(self, batch_size: int = 500, with_embeddings: bool = False) -> Iterator[User]:
+        """Lazily iterate over all users stored in Redis.
+
+        every SCAN page is fetched with a single pipeline, so memory usage is
+        bounded by batch_size and round-trips are ~ N / batch_size,
+        embeddings are only loaded if with_embeddings is set"""
+        for keys in self._scan_pages("user::*", batch_size):
+            yield from self._fetch(keys, with_embeddings)
+
+    @timed
+    def get_embeddings(self, user_id: int, kind: str = "face"):
+        """(n, dim) or (dim,) float32 numpy array of the face/voice embeddings
+        of a user, a read-only view over the redis reply, None if not enrolled"""
+        assert kind in ["face", "voice"]
+        blob = self.r.get(_embeddings_key(user_id, kind))
+        inline = None
+        if not blob:
+            # not yet migrated, raw float32 bytes in the user hash
+            try:
+                inline = self.r.hget(_user_key(user_id), kind + "_embeddings")
+            except redis.ResponseError:  # WRONGTYPE, json string
+                return None
+        return self._decode_embeddings(blob, inline)
+
+    def iter_embeddings(self, kind: str = "face",
+                        batch_size: int = 500) -> Iterator[Tuple[str, "np.ndarray"]]:
+        """Lazily iterate over the (user_id, embeddings array) of every enrolled user,
+        one MGET per SCAN page, user profiles are not transferred"""
+        assert kind in ["face", "voice"]
+        for keys in self._scan_pages(f"user_emb::*::{kind}", batch_size):
+            yield from self._embeddings_entries(keys, self.r.mget(keys))
+
+    @timed
+    def migrate(self, batch_size: int = 500) -> int:
+        """convert users stored by older versions of this package, json strings
+        become redis hashes and embeddings stored inside the hash are moved to
+        their binary keys, returns the number of migrated users"""
+        n = 0
+        for keys in self._scan_pages("user::*", batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for key in keys:
+                pipe.type(key)
+            legacy, hashes = self._split_by_type(keys, pipe.execute())
+            pipe = self.r.pipeline(transaction=False)
+            for key in hashes:
+                pipe.hmget(key, ["user_id", "revision", *_BINARY_FIELDS])
+            for key, (uid, rev, *values) in zip(hashes, pipe.execute()):
+                pipe = self.r.pipeline(transaction=True)
+                if self._queue_inline_migration(pipe, key, uid, rev, values):
+                    pipe.execute()
+                    n += 1
+            for key in legacy:
+                user, _ = self._legacy_user(self.r.get(key))
+                if not user:
+                    continue
+                pipe = self.r.pipeline(transaction=True)
+                pipe.delete(key)
+                # indexed and counted like a new user, no rebuild_indexes needed
+                _queue_add(pipe, user)
+                pipe.execute()
+                n += 1
+        # databases this old predate the user_id counter
+        self._advance_id_counter(self._highest_user_id())
+        if next(self.r.scan_iter(_LEGACY_AUTH_PHRASE_INDEX), None) is not None:
+            # plain text auth phrase index keys, replaced by hashed ones
+            self.rebuild_indexes()
+        if n:
+            self.invalidate()
+        return n
 
     def count(self) -> int:
-        return len(list(self.r.scan_iter("user::*")))
\ No newline at end of file
+        """Number of users stored in Redis."""
+        return self.r.scard(_ID_SET_KEY)
+
+
+def user_db_from_config(config: Optional[dict] = None) -> BaseUserDB:
+    """create the user database selected in the "user_db" config section
+
+    "backend" is "redis" (default) or "sqlite", the sqlite file is set in "path"
+    """
+    if config is None:
+        config = Configuration().get("user_db", {})
+    backend = config.get("backend", "redis")
+    if backend == "sqlite":
+        from ovos_user_id.sqlite_db import SQLiteUserDB
+        return SQLiteUserDB(config.get("path"))
+    if backend != "redis":
+        raise ValueError(f"unknown user_db backend: {backend}")
+    return UserDB()
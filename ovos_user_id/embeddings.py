@@ -0,0 +1,233 @@
+import asyncio
+from threading import RLock
+from typing import Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+
+from ovos_utils.log import LOG
+
+from ovos_user_id.db import BaseUserDB
+
+if TYPE_CHECKING:
+    import numpy as np
+    from ovos_user_id.aio import AsyncUserDB
+
+
+class EmbeddingIndex:
+    """in-memory 1:N identification index over the face or voice embeddings of every user
+
+    all embeddings live in a single contiguous float32 matrix of L2 normalized
+    rows, identification is one matrix-vector product (cosine similarity)
+
+    a user may have several embeddings (stored concatenated, dim floats each),
+    scores are the best match among them, or if use_centroids is set each
+    user is represented by the normalized mean of its embeddings
+    """
+
+    def __init__(self, kind: str = "face", dim: Optional[int] = None,
+                 use_centroids: bool = False, capacity: int = 1024):
+        import numpy as np  # lazy, keeps package import fast
+        assert kind in ["face", "voice"]
+        self.kind = kind
+        self.field = kind + "_embeddings"
+        self.dim = dim
+        self.use_centroids = use_centroids
+        self._np = np
+        self._matrix = None if dim is None else np.zeros((capacity, dim), dtype=np.float32)
+        self._capacity = capacity
+        self._n = 0  # rows in use
+        self._row_owner: List[str] = []  # row -> user_id
+        self._user_rows: Dict[str, List[int]] = {}  # user_id -> rows
+        self._db: Optional[BaseUserDB] = None
+        self._lock = RLock()
+
+    @property
+    def matrix(self):
+        """the (n, dim) float32 matrix of normalized embeddings in use"""
+        if self._matrix is None:
+            return self._np.zeros((0, self.dim or 0), dtype=self._np.float32)
+        return self._matrix[:self._n]
+
+    def __len__(self) -> int:
+        return len(self._user_rows)
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self._user_rows
+
+    # building
+    def _as_rows(self, embeddings: Union[bytes, "np.ndarray"]):
+        np = self._np
+        if isinstance(embeddings, (bytes, bytearray, memoryview)):
+            embeddings = np.frombuffer(embeddings, dtype=np.float32)
+        rows = np.asarray(embeddings, dtype=np.float32)
+        if self.dim is None:
+            # unknown dimension, assume a single embedding per user
+            self.dim = rows.shape[-1]
+        rows = rows.reshape(-1, self.dim)
+        if self.use_centroids and len(rows) > 1:
+            rows = rows.mean(axis=0, keepdims=True)
+        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return rows / norms
+
+    def _grow(self, needed: int):
+        np = self._np
+        if self._matrix is None:
+            self._capacity = max(self._capacity, needed)
+            self._matrix = np.zeros((self._capacity, self.dim), dtype=np.float32)
+        elif needed > self._capacity:
+            self._capacity = max(needed, self._capacity * 2)
+            grown = np.zeros((self._capacity, self.dim), dtype=np.float32)
+            grown[:self._n] = self._matrix[:self._n]
+            self._matrix = grown
+
+    def add(self, user_id, embeddings: Union[bytes, "np.ndarray"]):
+        """add (or replace) the embeddings of a user"""
+        with self._lock:
+            self.remove(user_id)
+            rows = self._as_rows(embeddings)
+            if not len(rows):
+                return
+            self._grow(self._n + len(rows))
+            self._matrix[self._n:self._n + len(rows)] = rows
+            uid = str(user_id)
+            self._user_rows[uid] = list(range(self._n, self._n + len(rows)))
+            self._row_owner.extend([uid] * len(rows))
+            self._n += len(rows)
+
+    update = add
+
+    def remove(self, user_id):
+        """drop all embeddings of a user, the last rows are moved into the gap"""
+        with self._lock:
+            rows = self._user_rows.pop(str(user_id), None)
+            if not rows:
+                return
+            for row in sorted(rows, reverse=True):
+                last = self._n - 1
+                if row != last:
+                    moved = self._row_owner[last]
+                    self._matrix[row] = self._matrix[last]
+                    self._row_owner[row] = moved
+                    owner_rows = self._user_rows[moved]
+                    owner_rows[owner_rows.index(last)] = row
+                self._row_owner.pop()
+                self._n -= 1
+
+    def clear(self):
+        with self._lock:
+            self._n = 0
+            self._row_owner = []
+            self._user_rows = {}
+
+    # search
+    def search_batch(self, queries, top_k: int = 3) -> List[List[Tuple[str, float]]]:
+        """top_k (user_id, cosine similarity) for each query embedding, best first
+
+        all queries are scored with a single matrix product"""
+        np = self._np
+        q = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim or np.shape(queries)[-1])
+        norms = np.linalg.norm(q, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        with self._lock:
+            if not self._n:
+                return [[] for _ in range(len(q))]
+            scores = (q / norms) @ self._matrix[:self._n].T  # (queries, rows)
+            owners = list(self._row_owner)
+        results = []
+        for row_scores in scores:
+            best: Dict[str, float] = {}
+            # users can own several rows, keep fetching candidates until top_k users are found
+            k = min(len(row_scores), top_k)
+            while True:
+                cand = np.argpartition(-row_scores, k - 1)[:k]
+                for row in cand[np.argsort(-row_scores[cand])]:
+                    uid = owners[row]
+                    if uid not in best:
+                        best[uid] = float(row_scores[row])
+                if len(best) >= top_k or k == len(row_scores):
+                    break
+                best.clear()
+                k = min(len(row_scores), k * 2)
+            results.append(sorted(best.items(), key=lambda kv: kv[1], reverse=True)[:top_k])
+        return results
+
+    def search(self, query, top_k: int = 3) -> List[Tuple[str, float]]:
+        """top_k (user_id, cosine similarity) for a single embedding, best first"""
+        return self.search_batch(query, top_k)[0]
+
+    def identify(self, query, threshold: float = 0.0) -> Optional[Tuple[str, float]]:
+        """best matching (user_id, cosine similarity), None if below threshold"""
+        best = self.search(query, top_k=1)
+        if best and best[0][1] >= threshold:
+            return best[0]
+        return None
+
+    # UserDB integration
+    def _load_user(self, user_id):
+        self._set_user(user_id, self._db.get_embeddings(user_id, self.kind))
+
+    def _set_user(self, user_id, data):
+        if data is not None and data.size:
+            self.add(user_id, data)
+        else:
+            self.remove(user_id)
+
+    def _on_user_changed(self, user_id):
+        try:
+            if user_id is None:
+                self.load(self._db)
+            else:
+                self._load_user(user_id)
+        except Exception as e:
+            LOG.error(f"failed to update {self.kind} embedding index: {e}")
+
+    def load(self, db: BaseUserDB):
+        """(re)load the embeddings of every user in db"""
+        with self._lock:
+            self._db = db
+            # only the binary embeddings are transferred, not the user profiles
+            self._replace(db.iter_embeddings(self.kind))
+
+    def _replace(self, entries):
+        with self._lock:
+            self.clear()
+            for user_id, data in entries:
+                try:
+                    self.add(user_id, data)
+                except ValueError as e:  # wrong dimension
+                    LOG.error(f"invalid {self.field} for user {user_id}: {e}")
+
+    # AsyncUserDB integration, listeners are called from its event loop
+    async def _reload_async(self, user_id):
+        try:
+            if user_id is None:
+                await self.load_async(self._db)
+            else:
+                self._set_user(user_id, await self._db.get_embeddings(user_id, self.kind))
+        except Exception as e:
+            LOG.error(f"failed to update {self.kind} embedding index: {e}")
+
+    def _on_user_changed_async(self, user_id):
+        asyncio.ensure_future(self._reload_async(user_id))
+
+    async def load_async(self, db: "AsyncUserDB"):
+        """(re)load the embeddings of every user in an AsyncUserDB"""
+        self._db = db
+        # the lock is not held across awaits, the index is swapped at once
+        self._replace([entry async for entry in db.iter_embeddings(self.kind)])
+
+    @classmethod
+    def from_db(cls, db: BaseUserDB, kind: str = "face", **kwargs) -> "EmbeddingIndex":
+        """build an index kept up to date with add_user/update_user/delete_user,
+        including changes made by other processes"""
+        index = cls(kind, **kwargs)
+        index.load(db)
+        db.add_listener(index._on_user_changed)
+        return index
+
+    @classmethod
+    async def from_async_db(cls, db: "AsyncUserDB", kind: str = "face", **kwargs) -> "EmbeddingIndex":
+        """see from_db, changes are applied by tasks scheduled on the event loop of db"""
+        index = cls(kind, **kwargs)
+        await index.load_async(db)
+        db.add_listener(index._on_user_changed_async)
+        return index
@@ -0,0 +1,474 @@
+"""latency/round-trip instrumentation of the user database, recognition and session injection
+
+disabled by default, instrumented functions then only pay one attribute
+check, enable it in mycroft.conf
+
+    "user_metrics": {
+        "enabled": true,
+        "prometheus_file": "/var/lib/node_exporter/ovos_user_id.prom",
+        "prometheus_port": 9464,
+        "interval": 15
+    }
+
+recorded:
+    ovos_user_id_op_seconds          histogram per instrumented operation
+    ovos_user_id_redis_*             commands sent (per command), round trips,
+                                     bytes sent/received, time waiting for replies
+    ovos_user_id_payload_bytes_total camera frames / mic audio / embeddings read
+    ovos_user_id_cache_*             hits, misses and size of the registered caches
+
+exported by MetricsSink implementations, a prometheus text file rewritten
+every interval seconds, a prometheus http endpoint (/metrics) and the
+messagebus, "ovos.user_id.metrics.get" is answered with a json snapshot
+"""
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import nullcontext
+from functools import wraps
+from inspect import iscoroutinefunction
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ovos_config import Configuration
+from ovos_utils.log import LOG
+
+GET_METRICS = "ovos.user_id.metrics.get"
+
+# seconds, from a cache hit to a slow model
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """cumulative latency histogram with fixed bucket bounds (not thread safe, see Metrics)"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """upper bound of the bucket holding the q quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def as_dict(self) -> dict:
+        return {"count": self.count,
+                "sum": self.sum,
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99)}
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+_NULL_TIMER = nullcontext()
+
+
+class Metrics:
+    """process wide registry, use the METRICS instance"""
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms: Dict[str, Histogram] = {}
+        # (name, label value) -> value, see _COUNTERS
+        self.counters: Dict[Tuple[str, str], float] = {}
+        self.caches = weakref.WeakValueDictionary()  # name -> TTLCache
+        self.sinks: List["MetricsSink"] = []
+        self._clients = weakref.WeakSet()  # redis clients of this package, see instrument
+        self._lock = threading.Lock()
+
+    # recording
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(seconds)
+
+    def inc(self, name: str, label: str = "", value: float = 1):
+        key = (name, label)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timer(self, name: str):
+        """context manager timing its block, a no-op while disabled"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def add_payload(self, source: str, data):
+        """count bytes of a camera frame/mic audio/embeddings read from redis"""
+        if self.enabled and data is not None:
+            self.inc("payload_bytes", source, len(data))
+
+    def register_cache(self, name: str, cache):
+        """report hits/misses of a TTLCache, only a weak reference is kept, returns the cache"""
+        self.caches[name] = cache
+        return cache
+
+    # lifecycle
+    def instrument(self, client):
+        """count the redis traffic of a redis.Redis client (ovos_user_id.redis_conn
+        registers the shared client), other redis users in the process are not counted
+
+        a disabled registry leaves the client untouched"""
+        self._clients.add(client)
+        if self.enabled:
+            _instrument_pool(client.connection_pool, self)
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            for client in list(self._clients):
+                _instrument_pool(client.connection_pool, self)
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def add_sink(self, sink: "MetricsSink"):
+        """start sink and register it, a sink that fails to start is not kept"""
+        sink.start(self)
+        self.sinks.append(sink)
+
+    def shutdown(self):
+        for sink in self.sinks:
+            sink.stop()
+        self.sinks.clear()
+
+    # export
+    def snapshot(self) -> dict:
+        """json friendly view of every metric"""
+        with self._lock:
+            ops = {name: hist.as_dict() for name, hist in self.histograms.items()}
+            counters: Dict[str, Dict[str, float]] = {}
+            for (name, label), value in self.counters.items():
+                counters.setdefault(name, {})[label or "total"] = value
+        return {"enabled": self.enabled,
+                "operations": ops,
+                "counters": counters,
+                "caches": {name: cache.stats for name, cache in list(self.caches.items())}}
+
+    def prometheus_text(self) -> str:
+        """every metric in the prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            histograms = [(name, list(h.counts), h.sum, h.count, h.buckets)
+                          for name, h in sorted(self.histograms.items())]
+            counters = sorted(self.counters.items())
+        lines.append("# TYPE ovos_user_id_op_seconds histogram")
+        for name, counts, total, count, buckets in histograms:
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append(f'ovos_user_id_op_seconds_bucket{{op="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'ovos_user_id_op_seconds_bucket{{op="{name}",le="+Inf"}} {count}')
+            lines.append(f'ovos_user_id_op_seconds_sum{{op="{name}"}} {total}')
+            lines.append(f'ovos_user_id_op_seconds_count{{op="{name}"}} {count}')
+        declared = set()
+        for (name, label), value in counters:
+            metric, label_name = _COUNTERS.get(name, (name, "label"))
+            metric = f"ovos_user_id_{metric}"
+            if metric not in declared:
+                lines.append(f"# TYPE {metric} counter")
+                declared.add(metric)
+            labels = f'{{{label_name}="{label}"}}' if label else ""
+            lines.append(f"{metric}{labels} {value}")
+        caches = {name: cache.stats for name, cache in list(self.caches.items())}
+        for metric, key, kind in (("cache_hits_total", "hits", "counter"),
+                                  ("cache_misses_total", "misses", "counter"),
+                                  ("cache_size", "size", "gauge")):
+            lines.append(f"# TYPE ovos_user_id_{metric} {kind}")
+            for name, stats in sorted(caches.items()):
+                lines.append(f'ovos_user_id_{metric}{{cache="{name}"}} {stats[key]}')
+        return "\n".join(lines) + "\n"
+
+
+# counter name -> (prometheus metric name, label name)
+_COUNTERS = {
+    "redis_commands": ("redis_commands_total", "command"),
+    "redis_round_trips": ("redis_round_trips_total", "label"),
+    "redis_sent_bytes": ("redis_sent_bytes_total", "label"),
+    "redis_received_bytes": ("redis_received_bytes_total", "label"),
+    "redis_wait_seconds": ("redis_wait_seconds_total", "label"),
+    "payload_bytes": ("payload_bytes_total", "source"),
+}
+
+METRICS = Metrics()
+
+
+def timed(func: Optional[Callable] = None, *, name: Optional[str] = None):
+    """record the latency of every call of func (sync or async) under name,
+    defaults to the function __qualname__, eg. "UserDB.get_user"
+
+        @timed
+        def get_user(...)
+    """
+    if func is None:
+        return lambda f: timed(f, name=name)
+    name = name or func.__qualname__
+
+    if iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                METRICS.observe(name, time.perf_counter() - start)
+
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not METRICS.enabled:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            METRICS.observe(name, time.perf_counter() - start)
+
+    return wrapper
+
+
+# redis
+def _reply_size(reply) -> int:
+    """approximate bytes of a parsed redis reply"""
+    if isinstance(reply, (bytes, str, bytearray, memoryview)):
+        return len(reply)
+    if isinstance(reply, (list, tuple)):
+        return sum(_reply_size(r) for r in reply)
+    if isinstance(reply, dict):
+        return sum(_reply_size(k) + _reply_size(v) for k, v in reply.items())
+    return 8
+
+
+def _command_name(args) -> str:
+    name = args[0]
+    return (name.decode("utf-8") if isinstance(name, bytes) else str(name)).upper()
+
+
+_METERED: Dict[type, type] = {}  # connection class -> metered subclass
+
+
+def _metered_connection_class(cls: type, metrics: Metrics) -> type:
+    """subclass of a redis-py connection class recording commands, round trips,
+    bytes sent/received and time waiting for replies (pub/sub messages of the
+    invalidation listener are not counted)"""
+    if getattr(cls, "_ovos_user_id_metered", False):
+        return cls
+    if cls in _METERED:
+        return _METERED[cls]
+    from redis.client import PubSubWorkerThread
+
+    def counted() -> bool:
+        return metrics.enabled and not isinstance(threading.current_thread(), PubSubWorkerThread)
+
+    class MeteredConnection(cls):
+        _ovos_user_id_metered = True
+
+        def send_command(self, *args, **kwargs):
+            if counted():
+                metrics.inc("redis_commands", _command_name(args))
+            return super().send_command(*args, **kwargs)
+
+        def pack_commands(self, commands):
+            if counted():
+                commands = list(commands)
+                for args in commands:
+                    metrics.inc("redis_commands", _command_name(args))
+            return super().pack_commands(commands)
+
+        def send_packed_command(self, command, check_health=True):
+            if counted():
+                metrics.inc("redis_round_trips")
+                metrics.inc("redis_sent_bytes", value=_reply_size(command))
+            return super().send_packed_command(command, check_health)
+
+        def read_response(self, *args, **kwargs):
+            if not counted():
+                return super().read_response(*args, **kwargs)
+            start = time.perf_counter()
+            response = super().read_response(*args, **kwargs)
+            metrics.inc("redis_wait_seconds", value=time.perf_counter() - start)
+            metrics.inc("redis_received_bytes", value=_reply_size(response))
+            return response
+
+    MeteredConnection.__name__ = MeteredConnection.__qualname__ = "Metered" + cls.__name__
+    _METERED[cls] = MeteredConnection
+    return MeteredConnection
+
+
+def _instrument_pool(pool, metrics: Metrics):
+    """meter the connections of a redis connection pool, including the ones already open"""
+    original = pool.connection_class
+    metered = _metered_connection_class(original, metrics)
+    pool.connection_class = metered
+    # ConnectionPool keeps _available/_in_use_connections, BlockingConnectionPool _connections,
+    # the subclass adds no state so open connections can simply switch class
+    for conn in (*getattr(pool, "_available_connections", ()),
+                 *getattr(pool, "_in_use_connections", ()),
+                 *getattr(pool, "_connections", ())):
+        if type(conn) is original:
+            conn.__class__ = metered
+
+
+# sinks
+class MetricsSink:
+    """exports a Metrics registry, started by Metrics.add_sink"""
+
+    def start(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def stop(self):
+        pass
+
+
+class PrometheusFileSink(MetricsSink):
+    """rewrites a prometheus text file every interval seconds, eg. for the
+    node_exporter textfile collector, the file is replaced atomically"""
+
+    def __init__(self, path: str, interval: float = 15):
+        self.path = os.path.expanduser(path)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, metrics: Metrics):
+        super().start(metrics)
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="user-metrics-file")
+        self._thread.start()
+
+    def write(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.metrics.prometheus_text())
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                LOG.warning(f"failed to write metrics to {self.path}: {e}")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+            self._thread = None
+        try:
+            self.write()  # final values
+        except OSError:
+            pass
+
+
+class PrometheusHTTPSink(MetricsSink):
+    """serves the prometheus text format on http://host:port/metrics"""
+
+    def __init__(self, port: int = 9464, host: str = "127.0.0.1"):
+        self.port = port
+        self.host = host
+        self._server = None
+
+    def start(self, metrics: Metrics):
+        super().start(metrics)
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass  # no access log
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True,
+                         name="user-metrics-http").start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class BusMetricsSink(MetricsSink):
+    """answers "ovos.user_id.metrics.get" with Metrics.snapshot()"""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def start(self, metrics: Metrics):
+        super().start(metrics)
+        self.bus.on(GET_METRICS, self.handle_get)
+
+    def handle_get(self, message):
+        self.bus.emit(message.response(self.metrics.snapshot()))
+
+    def stop(self):
+        self.bus.remove(GET_METRICS, self.handle_get)
+
+
+def configure_metrics(bus=None, config: Optional[dict] = None) -> Metrics:
+    """enable METRICS and start the sinks from the "user_metrics" config section,
+    the bus sink is added if a bus is given, calling it again only adds missing sinks"""
+    if config is None:
+        config = Configuration().get("user_metrics", {})
+    if not config.get("enabled", False):
+        return METRICS
+    METRICS.enable()
+    kinds = {type(sink) for sink in METRICS.sinks}
+    if config.get("prometheus_file") and PrometheusFileSink not in kinds:
+        METRICS.add_sink(PrometheusFileSink(config["prometheus_file"], config.get("interval", 15)))
+    if config.get("prometheus_port") and PrometheusHTTPSink not in kinds:
+        try:
+            METRICS.add_sink(PrometheusHTTPSink(config["prometheus_port"], config.get("host", "127.0.0.1")))
+        except OSError as e:  # port in use, eg. by another process importing the plugin
+            LOG.warning(f"metrics endpoint not started: {e}")
+    if bus is not None and BusMetricsSink not in kinds:
+        METRICS.add_sink(BusMetricsSink(bus))
+    return METRICS
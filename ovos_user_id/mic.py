@@ -1,24 +1,185 @@
-from typing import Optional
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional, Dict, Iterator, List
 from ovos_bus_client.message import Message
-from ovos_config import Configuration
 import redis
 
+from ovos_user_id.metrics import METRICS, timed
+from ovos_user_id.redis_conn import get_redis
+
+# longest wait for the next chunk of an utterance in get_chunks/get_array, seconds
+UTTERANCE_TIMEOUT = 10.0
+
+
+@dataclass
+class AudioChunk:
+    seq: str  # redis stream entry id, increases with every published chunk
+    timestamp: float  # unix time the chunk was captured
+    utterance_id: str  # all chunks of the same utterance share this id
+    data: bytes  # raw PCM
+    sample_rate: int = 16000
+    sample_width: int = 2  # bytes per sample, 2 -> int16, 4 -> float32
+    channels: int = 1
+    final: bool = False  # last chunk of the utterance
+
+    def array(self, dtype: str = "int16"):
+        """numpy view of the samples, no copy if dtype matches the sample width"""
+        return _to_array(self.data, self.sample_width, dtype)
+
+
+def _to_array(data: bytes, sample_width: int, dtype: str = "int16"):
+    import numpy as np  # lazy, keeps package import fast
+    if sample_width == 2:
+        stored = np.int16
+    elif sample_width == 4:
+        stored = np.float32
+    else:
+        raise ValueError(f"unsupported sample width: {sample_width} bytes (int16 or float32 audio)")
+    a = np.frombuffer(data, dtype=stored)  # zero-copy view
+    if np.dtype(dtype) == a.dtype:
+        return a
+    if stored == np.int16:
+        return a.astype(np.float32) / 32768.0
+    return (np.clip(a, -1.0, 1.0) * 32767).astype(np.int16)
+
 
 class RedisMicReader:
-    """access mic from https://github.com/OpenVoiceOS/ovos-...-redis-mic"""
-    def __init__(self,  mic_id: str):
-        # Redis connection
-        kwargs = Configuration().get("redis", {"host": "127.0.0.1", "port": 6379})
-        self.r = redis.Redis(**kwargs)
-        self.r.ping()
+    """access mic from https://github.com/OpenVoiceOS/ovos-...-redis-mic
+
+    get() returns the last STT audio, in streaming mode audio is published in
+    chunks to the "{mic_id}::stream" redis stream (a ring buffer, see
+    RedisMicWriter) and can be processed while the utterance is still ongoing
+    """
+    def __init__(self, mic_id: str, r: Optional[redis.Redis] = None):
+        # Redis connection, defaults to the shared connection pool
+        self.r = r or get_redis()
         self.mic_id = mic_id
+        self.stream = mic_id + "::stream"
+        # stream id of the first chunk of the current utterance
+        self.utterance_key = mic_id + "::utterance"
 
+    @timed
     def get(self):
         """Retrieve Numpy array from Redis mic 'self.name' """
-        return self.r.get(self.mic_id)
+        audio = self.r.get(self.mic_id)
+        METRICS.add_payload("mic", audio)
+        return audio
+
+    @staticmethod
+    def _parse_entry(entry_id: bytes, fields: dict) -> AudioChunk:
+        fields = {k.decode("utf-8"): v for k, v in fields.items()}
+        METRICS.add_payload("mic", fields["data"])
+        return AudioChunk(seq=entry_id.decode("utf-8"),
+                          timestamp=float(fields["ts"]),
+                          utterance_id=fields["utt"].decode("utf-8"),
+                          data=fields["data"],
+                          sample_rate=int(fields["rate"]),
+                          sample_width=int(fields["width"]),
+                          channels=int(fields["channels"]),
+                          final=fields["final"] == b"1")
+
+    def iter_chunks(self, timeout: Optional[float] = None,
+                    after: Optional[str] = None) -> Iterator[AudioChunk]:
+        """yield the chunks of the current utterance as they are published,
+        from its start (or after the chunk with id 'after') until the final
+        chunk, stops if no chunk arrives within timeout seconds (None waits forever)"""
+        utt = None
+        if after is None:
+            start = self.r.get(self.utterance_key)
+            if not start:
+                return
+            # XRANGE is inclusive, the first chunk is part of the utterance
+            pending = self.r.xrange(self.stream, min=start)
+        else:
+            pending = []
+        last = after
+        block = 0 if timeout is None else max(int(timeout * 1000), 1)
+        while True:
+            for entry in pending:
+                chunk = self._parse_entry(*entry)
+                utt = utt or chunk.utterance_id
+                if chunk.utterance_id != utt:
+                    return  # a new utterance started, the final chunk was trimmed
+                last = chunk.seq
+                yield chunk
+                if chunk.final:
+                    return
+            res = self.r.xread({self.stream: last or "$"}, block=block)
+            if not res:
+                return
+            pending = res[0][1]
+
+    def get_chunks(self, timeout: Optional[float] = UTTERANCE_TIMEOUT) -> List[AudioChunk]:
+        """all chunks of the current utterance, waits for it to end, gives up
+        if no chunk arrives within timeout seconds (None waits forever)"""
+        return list(self.iter_chunks(timeout))
+
+    def get_array(self, dtype: str = "int16", timeout: Optional[float] = UTTERANCE_TIMEOUT):
+        """samples of the current utterance as a numpy array (int16 or float32),
+        see get_chunks for timeout
+
+        falls back to the last STT audio from get() if no stream is available"""
+        chunks = self.get_chunks(timeout)
+        if chunks:
+            return _to_array(b"".join(c.data for c in chunks), chunks[0].sample_width, dtype)
+        audio = self.get()
+        if not audio:
+            return None
+        if audio[:4] == b"RIFF":
+            audio = audio[44:]  # skip the wav header
+        return _to_array(audio, 2, dtype)
+
+
+class RedisMicWriter:
+    """publish audio chunks to the "{mic_id}::stream" redis stream read by RedisMicReader
+
+    the stream is capped at maxlen chunks, acting as a ring buffer
+    """
+    def __init__(self, mic_id: str, r: Optional[redis.Redis] = None,
+                 sample_rate: int = 16000, sample_width: int = 2,
+                 channels: int = 1, maxlen: int = 2000):
+        if sample_width not in (2, 4):
+            raise ValueError(f"unsupported sample width: {sample_width} bytes (int16 or float32 audio)")
+        self.r = r or get_redis()
+        self.stream = mic_id + "::stream"
+        self.utterance_key = mic_id + "::utterance"
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.channels = channels
+        self.maxlen = maxlen
+        self.utterance_id: Optional[str] = None
+
+    def _add(self, data: bytes, final: bool) -> str:
+        seq = self.r.xadd(self.stream,
+                          {"ts": time.time(), "utt": self.utterance_id,
+                           "rate": self.sample_rate, "width": self.sample_width,
+                           "channels": self.channels, "final": int(final),
+                           "data": data},
+                          maxlen=self.maxlen, approximate=True)
+        return seq.decode("utf-8") if isinstance(seq, bytes) else seq
+
+    def put(self, data: bytes) -> str:
+        """publish a chunk of raw PCM, starting a new utterance if needed"""
+        if self.utterance_id is None:
+            self.utterance_id = str(uuid.uuid4())
+            seq = self._add(data, final=False)
+            self.r.set(self.utterance_key, seq)
+            return seq
+        return self._add(data, final=False)
+
+    def end_utterance(self, data: bytes = b"") -> Optional[str]:
+        """publish the final chunk of the current utterance"""
+        if self.utterance_id is None:
+            return None
+        seq = self._add(data, final=True)
+        self.utterance_id = None
+        return seq
 
 
 class MicManager:
+    # readers are cheap but reused per device, they share the redis connection pool
+    _readers: Dict[str, RedisMicReader] = {}
 
     @staticmethod
     def from_message(message: Message) -> Optional[RedisMicReader]:
@@ -27,11 +188,14 @@ class MicManager:
 
     @staticmethod
     def get(mic_id) -> Optional[RedisMicReader]:
-        return RedisMicReader(mic_id)
+        if mic_id not in MicManager._readers:
+            MicManager._readers[mic_id] = RedisMicReader(mic_id)
+        return MicManager._readers[mic_id]
 
 
 if __name__ == "__main__":
     remote_mic = RedisMicReader("laptop")
     while True:
-        audio = remote_mic.get()
-        # do stuff
\ No newline at end of file
+        for chunk in remote_mic.iter_chunks():
+            samples = chunk.array("float32")
+            # do stuff, incrementally
@@ -0,0 +1,75 @@
+from threading import Lock
+from typing import Optional
+
+import redis
+from ovos_config import Configuration
+
+from ovos_user_id.metrics import METRICS
+
+_client: Optional[redis.Redis] = None
+_async_client = None
+_lock = Lock()
+
+
+def _config() -> dict:
+    kwargs = dict(Configuration().get("redis", {"host": "127.0.0.1", "port": 6379}))
+    kwargs.setdefault("health_check_interval", 30)
+    return kwargs
+
+
+def get_redis() -> redis.Redis:
+    """shared redis client used by every module in this package
+
+    all connections come from a single pool, idle connections are health
+    checked (PING) before reuse instead of pinging on every new object,
+    pool size and health check interval can be set in the "redis" config
+    section via "max_connections" and "health_check_interval"
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = redis.Redis(**_config())
+                METRICS.instrument(_client)
+    return _client
+
+
+def get_async_redis():
+    """shared redis.asyncio client, the asyncio counterpart of get_redis
+
+    concurrent coroutines wait for a free connection of a bounded pool
+    ("max_connections", default 50) instead of opening one connection each
+
+    asyncio connections are bound to the event loop that created them,
+    this client must only be used from a single event loop"""
+    global _async_client
+    if _async_client is None:
+        import redis.asyncio  # lazy, only needed by async consumers
+        with _lock:
+            if _async_client is None:
+                kwargs = _config()
+                max_connections = kwargs.pop("max_connections", 50)
+                if kwargs.pop("ssl", False):
+                    kwargs["connection_class"] = redis.asyncio.SSLConnection
+                pool = redis.asyncio.BlockingConnectionPool(max_connections=max_connections, **kwargs)
+                _async_client = redis.asyncio.Redis(connection_pool=pool)
+    return _async_client
+
+
+def set_redis(client: Optional[redis.Redis]):
+    """replace the shared client, eg. to use an already configured connection,
+    None closes the current client and makes get_redis create a new one"""
+    global _client
+    with _lock:
+        if client is None and _client is not None:
+            _client.close()
+        _client = client
+    if client is not None:
+        METRICS.instrument(client)
+
+
+def set_async_redis(client):
+    """replace the shared redis.asyncio client"""
+    global _async_client
+    with _lock:
+        _async_client = client
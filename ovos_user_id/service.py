@@ -0,0 +1,288 @@
+"""face/voice recognition service
+
+owns the FaceEmbeddingsRecognizer/VoiceEmbeddingsRecognizer plugins and
+serves them over the messagebus, so the models are loaded once per host
+instead of once per process importing UserManager
+
+requests that arrive within batch_window seconds of each other are handled
+together, requests for the same frame/audio share a single prediction and
+recognizers implementing predict_batch get all inputs in one call
+
+bus api:
+    ovos.user_id.recognition.identify  {"kind", "device_id", "top_k"}
+        -> .response {"predictions": {user_id: score}, "latency", "batch_size"}
+    ovos.user_id.recognition.verify  {"kind", "device_id", "user_id"}
+        -> .response {"match": bool, "score", "latency", "batch_size"}
+    ovos.user_id.recognition.ping -> ovos.user_id.recognition.pong {"kinds": [...]}
+
+device_id is the camera_id for "face" and the mic_id for "voice", every
+request carries a "request_id" echoed in its response
+"""
+import time
+import uuid
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Set, Tuple
+
+from ovos_bus_client.message import Message
+from ovos_config import Configuration
+from ovos_utils.log import LOG
+
+from ovos_user_id.metrics import METRICS, configure_metrics, timed
+from ovos_user_id.users import UserManager
+
+IDENTIFY = "ovos.user_id.recognition.identify"
+VERIFY = "ovos.user_id.recognition.verify"
+PING = "ovos.user_id.recognition.ping"
+PONG = "ovos.user_id.recognition.pong"
+
+
+class RecognitionService:
+    """serves recognition requests over the messagebus, see module docstring"""
+
+    def __init__(self, bus, face_recognizer=None, voice_recognizer=None,
+                 batch_window: Optional[float] = None, max_batch: Optional[int] = None):
+        config = Configuration().get("user_recognition", {})
+        self.bus = bus
+        self.recognizers = {"face": face_recognizer, "voice": voice_recognizer}
+        # seconds to wait for more requests before running a batch
+        self.batch_window = config.get("batch_window", 0.01) if batch_window is None else batch_window
+        self.max_batch = max_batch or config.get("max_batch", 16)
+        self._queues: Dict[str, Queue] = {}
+        self._workers: List[Thread] = []
+        for kind, recognizer in self.recognizers.items():
+            if recognizer is None:
+                continue
+            self._queues[kind] = Queue()
+            worker = Thread(target=self._run_worker, args=(kind,), daemon=True,
+                            name=f"user-recognition-{kind}")
+            worker.start()
+            self._workers.append(worker)
+        self.bus.on(IDENTIFY, self.handle_request)
+        self.bus.on(VERIFY, self.handle_request)
+        self.bus.on(PING, self.handle_ping)
+        self._announce()
+
+    @property
+    def kinds(self) -> List[str]:
+        return list(self._queues)
+
+    def _announce(self, kinds: Optional[List[str]] = None):
+        self.bus.emit(Message(PONG, {"kinds": self.kinds if kinds is None else kinds}))
+
+    def handle_ping(self, message: Message):
+        self._announce()
+
+    def handle_request(self, message: Message):
+        kind = message.data.get("kind")
+        if kind not in self._queues:
+            self.bus.emit(message.response({"request_id": message.data.get("request_id"),
+                                            "error": f"no {kind} recognizer loaded"}))
+            return
+        self._queues[kind].put((message, time.monotonic()))
+
+    # batching
+    def _run_worker(self, kind: str):
+        queue = self._queues[kind]
+        while True:
+            request = queue.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    request = queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except Empty:
+                    break
+                if request is None:
+                    queue.put(None)  # stop after this batch
+                    break
+                batch.append(request)
+            try:
+                self._process(kind, batch)
+            except Exception as e:
+                LOG.exception(f"{kind} recognition batch failed")
+                for message, _ in batch:
+                    self.bus.emit(message.response({"request_id": message.data.get("request_id"),
+                                                    "error": str(e)}))
+
+    @timed
+    def _process(self, kind: str, batch: List[Tuple[Message, float]]):
+        recognizer = self.recognizers[kind]
+        get_input = UserManager._face_input if kind == "face" else UserManager._voice_input
+        top_k = max(max(int(m.data.get("top_k", 3)), 3) for m, _ in batch)
+
+        # requests for the same frame/audio are answered by a single prediction
+        groups: Dict = {}
+        fetchers: Dict = {}
+        inputs: Dict[str, Optional[Tuple]] = {}
+        for message, received in batch:
+            device_id = message.data.get("device_id")
+            if device_id not in inputs:
+                try:
+                    inputs[device_id] = get_input(device_id)
+                except Exception as e:
+                    LOG.warning(f"failed to read {kind} input from {device_id}: {e}")
+                    inputs[device_id] = None
+            if inputs[device_id] is None:
+                self._reply(message, received, {}, len(batch))
+                continue
+            content_id, fetch = inputs[device_id]
+            groups.setdefault(content_id, []).append((message, received))
+            fetchers[content_id] = fetch
+
+        preds: Dict = {}
+        missing = []
+        for content_id in groups:
+            cached = UserManager.prediction_cache.get((id(recognizer), content_id, top_k))
+            if cached is None:
+                missing.append(content_id)
+            else:
+                preds[content_id] = cached
+        if missing:
+            # (content id actually read, data), a trimmed camera frame is replaced by the newest one
+            fetched = [fetchers[content_id]() for content_id in missing]
+            data = [d for _, d in fetched]
+            with METRICS.timer(type(recognizer).__name__ + ".predict_batch"):
+                if hasattr(recognizer, "predict_batch"):
+                    results = recognizer.predict_batch(data, top_k=top_k)
+                else:
+                    results = [recognizer.predict(d, top_k=top_k) for d in data]
+            for content_id, (fetched_id, _), result in zip(missing, fetched, results):
+                preds[content_id] = result or {}
+                UserManager.prediction_cache.put((id(recognizer), fetched_id, top_k), preds[content_id])
+
+        for content_id, requests in groups.items():
+            for message, received in requests:
+                self._reply(message, received, preds[content_id], len(batch))
+
+    def _reply(self, message: Message, received: float, preds: Dict, batch_size: int):
+        data = {"request_id": message.data.get("request_id"),
+                "batch_size": batch_size}
+        if message.msg_type == VERIFY:
+            best = UserManager._best_match(preds)
+            data["match"] = best is not None and best == str(message.data.get("user_id"))
+            data["score"] = max(preds.values()) if preds else 0.0
+        else:
+            top_k = int(message.data.get("top_k", 3))
+            best = sorted(preds.items(), key=lambda kv: kv[1], reverse=True)[:top_k]
+            data["predictions"] = {str(uid): float(score) for uid, score in best}
+        data["latency"] = time.monotonic() - received
+        self.bus.emit(message.response(data))
+
+    def shutdown(self):
+        self._announce(kinds=[])
+        self.bus.remove(IDENTIFY, self.handle_request)
+        self.bus.remove(VERIFY, self.handle_request)
+        self.bus.remove(PING, self.handle_ping)
+        for queue in self._queues.values():
+            queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+class RecognitionClient:
+    """talks to a RecognitionService, used by UserManager for recognizers it does not load itself"""
+
+    def __init__(self, bus, timeout: float = 2.0):
+        self.bus = bus
+        self.timeout = timeout
+        self.kinds: Set[str] = set()  # recognizers offered by the service
+        self._pending: Dict[str, Tuple[Event, list]] = {}
+        self._lock = Lock()
+        self.bus.on(PONG, self.handle_pong)
+        self.bus.on(IDENTIFY + ".response", self.handle_response)
+        self.bus.on(VERIFY + ".response", self.handle_response)
+        # the service answers (or announces itself when it starts)
+        self.bus.emit(Message(PING))
+
+    def handle_pong(self, message: Message):
+        self.kinds = set(message.data.get("kinds", []))
+
+    def handle_response(self, message: Message):
+        with self._lock:
+            pending = self._pending.get(message.data.get("request_id"))
+        if pending:
+            event, result = pending
+            result.append(message.data)
+            event.set()
+
+    def available(self, kind: str) -> bool:
+        return kind in self.kinds
+
+    def _request(self, msg_type: str, data: dict, timeout: Optional[float] = None) -> dict:
+        """send a request and wait for the answer, timeout defaults to self.timeout"""
+        request_id = str(uuid.uuid4())
+        event, result = Event(), []
+        with self._lock:
+            self._pending[request_id] = (event, result)
+        try:
+            self.bus.emit(Message(msg_type, dict(data, request_id=request_id)))
+            if not event.wait(self.timeout if timeout is None else timeout):
+                raise TimeoutError(f"recognition service did not answer {msg_type}")
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+        if "error" in result[0]:
+            raise RuntimeError(result[0]["error"])
+        return result[0]
+
+    def identify(self, kind: str, device_id: str, top_k: int = 3,
+                 timeout: Optional[float] = None) -> Dict[str, float]:
+        """top_k {user_id: score} for the current camera frame / mic audio"""
+        return self._request(IDENTIFY, {"kind": kind, "device_id": device_id,
+                                        "top_k": top_k}, timeout)["predictions"]
+
+    def verify(self, kind: str, device_id: str, user_id,
+               timeout: Optional[float] = None) -> bool:
+        """the current camera frame / mic audio best matches user_id"""
+        return self._request(VERIFY, {"kind": kind, "device_id": device_id,
+                                      "user_id": str(user_id)}, timeout)["match"]
+
+    def shutdown(self):
+        self.bus.remove(PONG, self.handle_pong)
+        self.bus.remove(IDENTIFY + ".response", self.handle_response)
+        self.bus.remove(VERIFY + ".response", self.handle_response)
+
+
+def _load_recognizer(kind: str, config: dict):
+    """instantiate the plugin configured under user_recognition.{kind}, if any"""
+    if not config.get("module"):
+        return None
+    if kind == "face":
+        from ovos_plugin_manager.embeddings import load_face_embeddings_plugin as load_plugin
+    else:
+        from ovos_plugin_manager.embeddings import load_voice_embeddings_plugin as load_plugin
+    plugin = load_plugin(config["module"])
+    if plugin is None:
+        raise ImportError(f"{kind} recognition plugin not found: {config['module']}")
+    return plugin(config=config)
+
+
+def main():
+    """entry point of the ovos-user-recognition service"""
+    from ovos_bus_client import MessageBusClient
+    from ovos_utils import wait_for_exit_signal
+
+    config = Configuration().get("user_recognition", {})
+    face = _load_recognizer("face", config.get("face", {}))
+    voice = _load_recognizer("voice", config.get("voice", {}))
+    if face is None and voice is None:
+        LOG.error("no recognizer configured, set user_recognition.face/voice.module in mycroft.conf")
+        return
+
+    bus = MessageBusClient()
+    bus.run_in_thread()
+    bus.connected_event.wait()
+    configure_metrics(bus)
+    service = RecognitionService(bus, face, voice)
+    LOG.info(f"user recognition service ready: {service.kinds}")
+    wait_for_exit_signal()
+    service.shutdown()
+    METRICS.shutdown()
+    bus.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from ovos_config import Configuration
+
+from ovos_user_id.cache import TTLCache
+
+
+class SessionUserMap(ABC):
+    """session_id -> user_id bindings, dict like interface used by UserManager.sess2user"""
+
+    @abstractmethod
+    def get(self, session_id: str, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, session_id: str, user_id: Any):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, session_id: str):
+        raise NotImplementedError
+
+    def __getitem__(self, session_id: str) -> Any:
+        user_id = self.get(session_id)
+        if user_id is None:
+            raise KeyError(session_id)
+        return user_id
+
+    def __setitem__(self, session_id: str, user_id: Any):
+        self.set(session_id, user_id)
+
+    def __delitem__(self, session_id: str):
+        self.remove(session_id)
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def pop(self, session_id: str, default: Any = None) -> Any:
+        user_id = self.get(session_id, default)
+        self.remove(session_id)
+        return user_id
+
+
+class LocalSessionUserMap(SessionUserMap):
+    """in-process LRU map, bindings expire after ttl seconds without being used"""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 86400):
+        self._map = TTLCache(maxsize=max_size, ttl=ttl, sliding=True)
+
+    def get(self, session_id: str, default: Any = None) -> Any:
+        return self._map.get(session_id, default)
+
+    def set(self, session_id: str, user_id: Any):
+        self._map.put(session_id, user_id)
+
+    def remove(self, session_id: str):
+        self._map.pop(session_id)
+
+    def __len__(self) -> int:
+        return len(self._map)
+
+
+class RedisSessionUserMap(SessionUserMap):
+    """map shared by every node using the same redis, so a user recognised by
+    one ovos-core/hivemind instance is known to all of them
+
+    bindings expire after ttl seconds without being used, reads are served
+    from a small local near-cache for near_cache_ttl seconds, a binding
+    changed by another node may be seen that much later
+    """
+
+    def __init__(self, r, ttl: float = 86400,
+                 near_cache_size: int = 1024, near_cache_ttl: float = 5):
+        self.r = r
+        self.ttl = int(ttl)
+        self._near = TTLCache(maxsize=near_cache_size, ttl=near_cache_ttl)
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return "sess2user::" + session_id
+
+    def get(self, session_id: str, default: Any = None) -> Any:
+        user_id = self._near.get(session_id)
+        if user_id is not None:
+            return user_id
+        # GETEX refreshes the expiration of bindings in use
+        if self.ttl > 0:
+            data = self.r.getex(self._key(session_id), ex=self.ttl)
+        else:
+            data = self.r.get(self._key(session_id))
+        if data is None:
+            return default
+        user_id = json.loads(data)
+        self._near.put(session_id, user_id)
+        return user_id
+
+    def set(self, session_id: str, user_id: Any):
+        self.r.set(self._key(session_id), json.dumps(user_id),
+                   ex=self.ttl if self.ttl > 0 else None)
+        self._near.put(session_id, user_id)
+
+    def remove(self, session_id: str):
+        self.r.delete(self._key(session_id))
+        self._near.pop(session_id)
+
+
+def session_map_from_config(r=None, config: Optional[dict] = None) -> SessionUserMap:
+    """create the session map selected in the "user_db.session_map" config section
+
+    r is the redis connection used by the "redis" backend
+    """
+    if config is None:
+        config = Configuration().get("user_db", {}).get("session_map", {})
+    backend = config.get("backend", "memory")
+    ttl = config.get("ttl", 86400)
+    if backend == "redis":
+        if r is None:
+            raise ValueError("redis session map requires a redis connection")
+        return RedisSessionUserMap(r, ttl=ttl,
+                                   near_cache_size=config.get("near_cache_size", 1024),
+                                   near_cache_ttl=config.get("near_cache_ttl", 5))
+    if backend != "memory":
+        raise ValueError(f"unknown session map backend: {backend}")
+    return LocalSessionUserMap(max_size=config.get("max_size", 10000), ttl=ttl)
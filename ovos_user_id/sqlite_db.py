@@ -0,0 +1,399 @@
+"""SQLite storage backend of the user database, for standalone devices
+
+no server is needed, profiles live in a local file (WAL mode, readers never
+block) and lookups by name, alias, auth phrase, external id and organization
+are indexed queries, select it with
+
+    "user_db": {"backend": "sqlite", "path": "~/.local/share/ovos_user_id/users.db"}
+"""
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from threading import RLock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union, TYPE_CHECKING
+
+from ovos_utils.xdg_utils import xdg_data_home
+
+from ovos_user_id.codec import from_record
+from ovos_user_id.db import BaseUserDB, User, SCHEMA_VERSION, _BINARY_FIELDS, _REQUIRED_FIELDS, _check_fields, \
+    _check_new_user, _updated_fields, _dumps, _loads, pack_embeddings, unpack_embeddings, _embeddings_payload
+from ovos_user_id.metrics import timed
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# name, auth_phrase and organization_id are indexed columns, aliases and
+# external identifiers have their own tables, everything else is a json document
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY AUTOINCREMENT,  -- ids are never reused
+    name TEXT NOT NULL,
+    auth_phrase TEXT NOT NULL DEFAULT '',
+    organization_id TEXT NOT NULL DEFAULT '',
+    revision INTEGER NOT NULL DEFAULT 0,
+    schema_version INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_name ON users(name);
+CREATE INDEX IF NOT EXISTS users_auth_phrase ON users(auth_phrase) WHERE auth_phrase != '';
+CREATE INDEX IF NOT EXISTS users_organization ON users(organization_id);
+CREATE TABLE IF NOT EXISTS user_aliases (
+    alias TEXT NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    PRIMARY KEY (alias, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS user_aliases_user ON user_aliases(user_id);
+CREATE TABLE IF NOT EXISTS user_external_ids (
+    external_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    PRIMARY KEY (external_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS user_external_ids_user ON user_external_ids(user_id);
+CREATE TABLE IF NOT EXISTS user_embeddings (
+    user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (user_id, kind)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS import_progress (
+    source TEXT PRIMARY KEY,
+    done INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+_COLUMNS = "users.user_id, users.revision, users.schema_version, users.data"
+
+
+def _encode(user: User) -> Union[str, bytes]:
+    """User -> json document, user_id/revision are columns and embeddings have their own table"""
+    record = {k: v for k, v in user.as_dict.items()
+              if k not in _BINARY_FIELDS and k not in ("user_id", "revision")}
+    if isinstance(user.creation_date, datetime):
+        record["creation_date"] = user.creation_date.isoformat()
+    return _dumps(record)
+
+
+@timed(name="db.decode")
+def _decode(row: tuple, fields: Optional[Iterable[str]] = None,
+            embeddings: Optional[Dict[str, bytes]] = None) -> User:
+    """users row -> User, only the required fields plus fields if given
+
+    embeddings is None if they were not loaded, the User then has None
+    embeddings so updating it does not delete them (see UserDB.update_user)"""
+    user_id, revision, schema_version, data = row
+    record = _loads(data)
+    if fields is not None:
+        keep = set(_REQUIRED_FIELDS).union(fields)
+        record = {k: v for k, v in record.items() if k in keep}
+    record.update(user_id=user_id, revision=revision, schema_version=schema_version)
+    if embeddings is None:
+        if fields is None:
+            record.update({name: None for name in _BINARY_FIELDS})
+    else:
+        for name, blob in embeddings.items():
+            record[name] = _embeddings_payload(blob)
+    return from_record(record)
+
+
+class SQLiteUserDB(BaseUserDB):
+    """user database stored in a local SQLite file, same api as UserDB
+
+    a single connection is shared by all threads, listeners are notified of
+    changes made by other processes on the next read (PRAGMA data_version)
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        super().__init__()
+        if path is None:
+            path = os.path.join(str(xdg_data_home()), "ovos_user_id", "users.db")
+        if path != ":memory:":
+            path = os.path.expanduser(path)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = RLock()
+        # autocommit mode, transactions are managed explicitly in _transaction
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(_SCHEMA)
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock upfront, concurrent writers wait (busy_timeout)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            if self._listeners:
+                self._check_external_changes()
+            return self._conn.execute(sql, params).fetchall()
+
+    def poll_changes(self):
+        """see BaseUserDB.poll_changes, a single PRAGMA data_version query"""
+        with self._lock:
+            self._check_external_changes()
+
+    def _check_external_changes(self):
+        # data_version changes whenever another connection commits
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            self._notify(None)
+
+    # writes
+    @staticmethod
+    def _write_indexes(conn, user: User):
+        conn.execute("DELETE FROM user_aliases WHERE user_id = ?", (user.user_id,))
+        conn.executemany("INSERT OR IGNORE INTO user_aliases (alias, user_id) VALUES (?, ?)",
+                         [(alias, user.user_id) for alias in user.aliases])
+        conn.execute("DELETE FROM user_external_ids WHERE user_id = ?", (user.user_id,))
+        conn.executemany("INSERT OR IGNORE INTO user_external_ids (external_id, user_id) VALUES (?, ?)",
+                         [(str(ext_id), user.user_id) for ext_id in user.external_identifiers.values()])
+
+    @staticmethod
+    def _write_embeddings(conn, user: User, names: Iterable[str] = _BINARY_FIELDS):
+        for name in names:
+            kind = name.split("_")[0]
+            data = getattr(user, name)
+            if data is not None and len(data):
+                conn.execute("INSERT OR REPLACE INTO user_embeddings (user_id, kind, data) VALUES (?, ?, ?)",
+                             (user.user_id, kind, pack_embeddings(data)))
+            else:
+                conn.execute("DELETE FROM user_embeddings WHERE user_id = ? AND kind = ?",
+                             (user.user_id, kind))
+
+    def _insert(self, conn, user: User) -> User:
+        cur = conn.execute(
+            "INSERT INTO users (name, auth_phrase, organization_id, revision, schema_version, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user.name, user.auth_phrase, user.organization_id, user.revision,
+             SCHEMA_VERSION, _encode(user)))
+        user.user_id = cur.lastrowid
+        self._write_indexes(conn, user)
+        self._write_embeddings(conn, user)
+        return user
+
+    def _update(self, conn, user_id: int, changes: Dict) -> User:
+        rows = conn.execute(f"SELECT {_COLUMNS} FROM users WHERE user_id = ?", (user_id,)).fetchall()
+        if not rows:
+            raise ValueError("User not found")
+        user = _decode(rows[0])
+        updated = _updated_fields(changes)
+        for key in updated:
+            setattr(user, key, changes[key])
+        user.revision += 1
+        conn.execute("UPDATE users SET name = ?, auth_phrase = ?, organization_id = ?, revision = ?, "
+                     "schema_version = ?, data = ? WHERE user_id = ?",
+                     (user.name, user.auth_phrase, user.organization_id, user.revision,
+                      SCHEMA_VERSION, _encode(user), user_id))
+        if "aliases" in updated or "external_identifiers" in updated:
+            self._write_indexes(conn, user)
+        self._write_embeddings(conn, user, [k for k in updated if k in _BINARY_FIELDS])
+        return user
+
+    @timed
+    def add_user(self, name: str, discriminator: str, **kwargs) -> User:
+        """Add a new user to the database."""
+        assert discriminator in ["user", "agent", "group", "role"]
+        kwargs.pop("user_id", None)
+        _check_fields(kwargs)
+        with self._transaction() as conn:
+            user = self._insert(conn, User(user_id=0, name=name, discriminator=discriminator, **kwargs))
+        self._notify(str(user.user_id))
+        return user
+
+    @timed
+    def add_users(self, users: Iterable[Dict],
+                  progress: Optional[Tuple[str, int]] = None) -> List[User]:
+        """Add several users in a single transaction, see UserDB.add_users"""
+        users = [{k: v for k, v in u.items() if k not in ("user_id", "revision")}
+                 for u in users]
+        for u in users:
+            _check_new_user(u)
+        new_users = []
+        with self._transaction() as conn:
+            for u in users:
+                new_users.append(self._insert(conn, User(user_id=0, **u)))
+            if progress:
+                conn.execute("INSERT OR REPLACE INTO import_progress (source, done) VALUES (?, ?)", progress)
+        for user in new_users:
+            self._notify(str(user.user_id))
+        return new_users
+
+    def import_progress(self, source: str) -> int:
+        """see UserDB.import_progress"""
+        rows = self._query("SELECT done FROM import_progress WHERE source = ?", (source,))
+        return rows[0][0] if rows else 0
+
+    def clear_import_progress(self, source: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM import_progress WHERE source = ?", (source,))
+
+    @timed
+    def update_user(self, user_id: int, **kwargs) -> User:
+        """Update user information in the database."""
+        _check_fields(kwargs)
+        try:
+            with self._transaction() as conn:
+                user = self._update(conn, user_id, kwargs)
+        except sqlite3.Error as e:
+            raise ValueError(f"Failed to update user: {str(e)}")
+        self._notify(str(user_id))
+        return user
+
+    @timed
+    def update_users(self, updates: Dict[int, Dict]) -> List[User]:
+        """Update several users in a single transaction, all or nothing"""
+        for changes in updates.values():
+            _check_fields(changes)
+        try:
+            with self._transaction() as conn:
+                users = [self._update(conn, uid, changes) for uid, changes in updates.items()]
+        except ValueError:
+            missing = [uid for uid in updates if self.get_user(uid, fields=()) is None]
+            raise ValueError(f"Users not found: {missing}")
+        for uid in updates:
+            self._notify(str(uid))
+        return users
+
+    @timed
+    def delete_user(self, user_id: int):
+        """Delete a user from the database."""
+        self.delete_users([user_id])
+
+    @timed
+    def delete_users(self, user_ids: Iterable[int]) -> int:
+        """Delete several users, returns how many existed"""
+        user_ids = list(user_ids)
+        with self._transaction() as conn:
+            # aliases, external ids and embeddings are removed by ON DELETE CASCADE
+            n = sum(conn.execute("DELETE FROM users WHERE user_id = ?", (uid,)).rowcount
+                    for uid in user_ids)
+        for uid in user_ids:
+            self._notify(str(uid))
+        return n
+
+    # reads
+    def _embeddings_of(self, user_ids: List[int], names: Iterable[str] = _BINARY_FIELDS
+                       ) -> Dict[int, Dict[str, bytes]]:
+        kinds = [name.split("_")[0] for name in names]
+        if not user_ids or not kinds:
+            return {}
+        rows = self._query(
+            f"SELECT user_id, kind, data FROM user_embeddings WHERE user_id IN "
+            f"({','.join('?' * len(user_ids))}) AND kind IN ({','.join('?' * len(kinds))})",
+            (*user_ids, *kinds))
+        found: Dict[int, Dict[str, bytes]] = {}
+        for user_id, kind, blob in rows:
+            found.setdefault(user_id, {})[kind + "_embeddings"] = blob
+        return found
+
+    @timed
+    def get_user(self, user_id: int, fields: Optional[Iterable[str]] = None) -> Optional[User]:
+        """Get a user by user ID, see UserDB.get_user
+
+        embeddings are only loaded when explicitly requested in fields"""
+        rows = self._query(f"SELECT {_COLUMNS} FROM users WHERE user_id = ?", (user_id,))
+        if not rows:
+            return None
+        fields = tuple(fields) if fields is not None else None
+        binary = [f for f in fields if f in _BINARY_FIELDS] if fields else []
+        embeddings = self._embeddings_of([rows[0][0]], binary).get(rows[0][0], {}) if binary else None
+        return _decode(rows[0], fields, embeddings)
+
+    def _find(self, sql: str, value) -> List[User]:
+        return [_decode(row) for row in self._query(sql, (value,))]
+
+    @timed
+    def find_user(self, name: str) -> List[User]:
+        """Find users by name."""
+        return self._find(f"SELECT {_COLUMNS} FROM users WHERE name = ?", name)
+
+    @timed
+    def find_by_auth_phrase(self, auth_phrase: str) -> List[User]:
+        """Find users by authentication phrase."""
+        if not auth_phrase:
+            return []
+        return self._find(f"SELECT {_COLUMNS} FROM users WHERE auth_phrase = ? AND auth_phrase != ''",
+                          auth_phrase)
+
+    @timed
+    def find_user_by_alias(self, alias: str) -> List[User]:
+        """Find users by alias."""
+        return self._find(f"SELECT {_COLUMNS} FROM users JOIN user_aliases "
+                          f"ON user_aliases.user_id = users.user_id WHERE alias = ?", alias)
+
+    @timed
+    def find_by_external_id(self, id_string: Union[str, int]) -> List[User]:
+        """Find users by external identifier."""
+        return self._find(f"SELECT {_COLUMNS} FROM users JOIN user_external_ids "
+                          f"ON user_external_ids.user_id = users.user_id WHERE external_id = ?",
+                          str(id_string))
+
+    @timed
+    def find_by_organization(self, organization_id: str) -> List[User]:
+        """Find users by organization."""
+        return self._find(f"SELECT {_COLUMNS} FROM users WHERE organization_id = ?", organization_id)
+
+    def iter_users(self, batch_size: int = 500, with_embeddings: bool = False) -> Iterator[User]:
+        """Lazily iterate over all users, one query per batch_size users"""
+        last_id = 0
+        while True:
+            rows = self._query(f"SELECT {_COLUMNS} FROM users WHERE user_id > ? "
+                               f"ORDER BY user_id LIMIT ?", (last_id, batch_size))
+            if not rows:
+                return
+            embeddings = self._embeddings_of([row[0] for row in rows]) if with_embeddings else None
+            for row in rows:
+                yield _decode(row, embeddings=embeddings.get(row[0], {}) if with_embeddings else None)
+            last_id = rows[-1][0]
+
+    def count(self) -> int:
+        """Number of users stored in the database."""
+        return self._query("SELECT count(*) FROM users")[0][0]
+
+    @timed
+    def get_embeddings(self, user_id: int, kind: str = "face"):
+        """see UserDB.get_embeddings"""
+        assert kind in ["face", "voice"]
+        rows = self._query("SELECT data FROM user_embeddings WHERE user_id = ? AND kind = ?",
+                           (user_id, kind))
+        return unpack_embeddings(rows[0][0]) if rows else None
+
+    def iter_embeddings(self, kind: str = "face",
+                        batch_size: int = 500) -> Iterator[Tuple[str, "np.ndarray"]]:
+        """see UserDB.iter_embeddings"""
+        assert kind in ["face", "voice"]
+        last_id = 0
+        while True:
+            rows = self._query("SELECT user_id, data FROM user_embeddings WHERE kind = ? "
+                               "AND user_id > ? ORDER BY user_id LIMIT ?", (kind, last_id, batch_size))
+            if not rows:
+                return
+            for user_id, blob in rows:
+                yield str(user_id), unpack_embeddings(blob)
+            last_id = rows[-1][0]
+
+    @timed
+    def rebuild_indexes(self) -> int:
+        """recreate the alias and external id tables, returns the number of indexed users"""
+        n = 0
+        with self._transaction() as conn:
+            for row in conn.execute(f"SELECT {_COLUMNS} FROM users").fetchall():
+                self._write_indexes(conn, _decode(row))
+                n += 1
+        return n
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
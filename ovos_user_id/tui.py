@@ -1,14 +1,50 @@
+import base64
+import binascii
+import csv
+import json
+import os
+from dataclasses import fields
+from datetime import datetime
+from itertools import islice
+from typing import Dict, Iterator, Optional
+
 import click
-from ovos_user_id.db import UserDB
+from click.core import ParameterSource
+
+from ovos_user_id.codec import from_record, to_record
+from ovos_user_id.db import BaseUserDB, User, USER_FIELDS, user_db_from_config
+
+# fields stored as plain text in csv files, everything else is json encoded
+_CSV_TEXT_FIELDS = {f.name for f in fields(User) if f.type in (str, bytes, datetime)}
+_FIELD_TYPES = {f.name: f.type for f in fields(User)}
+
+
+def _parse_value(name: str, value):
+    """command line text -> User field value, lists/dicts are given as json
+    and embeddings as base64"""
+    if not isinstance(value, str) or name not in _FIELD_TYPES:
+        return value
+    field_type = _FIELD_TYPES[name]
+    option = "--" + name.replace("_", "-")
+    try:
+        if field_type is bytes:
+            return base64.b64decode(value, validate=True)
+        if field_type in (int, float):
+            return field_type(value)
+        if field_type not in (str, datetime):
+            return json.loads(value)
+    except (ValueError, binascii.Error) as e:
+        raise click.BadParameter(str(e), param_hint=option)
+    return value
 
 
 @click.group()
 @click.pass_context
-def cli(ctx, db_path):
+def cli(ctx):
     """Manage users in the database."""
     ctx.ensure_object(dict)
-    # TODO - allow redis config kwargs
-    ctx.obj["db"] = UserDB()
+    # redis or sqlite, as configured in the "user_db" section of mycroft.conf
+    ctx.obj["db"] = user_db_from_config()
 
 
 @cli.command()
@@ -18,8 +54,8 @@ def cli(ctx, db_path):
 @click.option("--aliases", default="[]", help="Alternate names (JSON format list).")
 @click.option("--auth-level", default=0, type=int, help="Authentication level (0-100).")
 @click.option("--auth-phrase", default="", help="Authentication phrase.")
-@click.option("--voice-embeddings", default=b"", help="Voice embeddings (binary).")
-@click.option("--face-embeddings", default=b"", help="Face embeddings (binary).")
+@click.option("--voice-embeddings", default="", help="Voice embeddings (base64 float32).")
+@click.option("--face-embeddings", default="", help="Face embeddings (base64 float32).")
 @click.option("--voice-samples", default="[]", help="Voice samples (JSON format list of paths).")
 @click.option("--face-samples", default="[]", help="Face samples (JSON format list of paths).")
 @click.option("--site-id", default="", help="Site ID.")
@@ -46,7 +82,10 @@ def cli(ctx, db_path):
 @click.pass_obj
 def add_user(obj, name, discriminator, **kwargs):
     """Add a new user to the database."""
-    user_data = {k.replace("-", "_"): v for k, v in kwargs.items() if v}
+    ctx = click.get_current_context()
+    # options left at their default keep the User default
+    user_data = {k: _parse_value(k, v) for k, v in kwargs.items()
+                 if ctx.get_parameter_source(k) is not ParameterSource.DEFAULT}
     try:
         user = obj["db"].add_user(name, discriminator, **user_data)
         click.echo(f"User '{user['name']}' added with ID: {user['user_id']}")
@@ -77,8 +116,10 @@ def update_user(obj, user_id, field, value):
         click.echo("Both --field and --value must be provided for updating.")
         return
 
+    field = field.replace("-", "_")
+    value = _parse_value(field, value)
     try:
-        user = obj["db"].update_user(user_id, **{field.replace("_", "-"): value})
+        user = obj["db"].update_user(user_id, **{field: value})
         click.echo(f"User '{user['name']}' updated successfully.")
     except ValueError as e:
         click.echo(f"Error: {e}")
@@ -100,14 +141,112 @@ def delete_user(obj, user_id):
 @click.pass_obj
 def list_users(obj):
     """List all users in the database."""
-    users = obj["db"].list_users()
-    if users:
-        click.echo("List of users:")
-        for user in users:
-            click.echo(f"ID: {user['user_id']}, Name: {user['name']}")
-    else:
+    found = False
+    for user in obj["db"].iter_users():
+        if not found:
+            click.echo("List of users:")
+            found = True
+        click.echo(f"ID: {user.user_id}, Name: {user.name}")
+    if not found:
         click.echo("No users found in the database.")
 
 
+def _read_records(stream, fmt: str) -> Iterator[Dict]:
+    """stream user records from a jsonl or csv file"""
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            yield {k: v if k in _CSV_TEXT_FIELDS else json.loads(v)
+                   for k, v in row.items() if (k in USER_FIELDS or k == "schema_version") and v != ""}
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _format(path: str, fmt: Optional[str]) -> str:
+    return fmt or ("csv" if path.endswith(".csv") else "jsonl")
+
+
+def _open(path: str, mode: str, fmt: str):
+    """path or "-" for stdin/stdout, csv files must not translate newlines"""
+    if path == "-":
+        return click.open_file(path, mode)
+    return open(path, mode, encoding="utf-8", newline="" if fmt == "csv" else None)
+
+
+@cli.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]), default=None,
+              help="File format, guessed from the extension by default.")
+@click.option("--batch-size", default=500, type=int, help="Users written per transaction.")
+@click.option("--checkpoint", default=None,
+              help="Name the import progress is stored under in the database, defaults to the absolute PATH.")
+@click.option("--restart", is_flag=True, help="Ignore the progress of an earlier import.")
+@click.pass_obj
+def import_users(obj, path, fmt, batch_size, checkpoint, restart):
+    """Import users from a JSONL or CSV file, new user ids are assigned.
+
+    interrupted imports resume after the last completed batch"""
+    db: BaseUserDB = obj["db"]
+    fmt = _format(path, fmt)
+    # progress is written in the same transaction as each batch, stdin can not be resumed unless named
+    checkpoint = checkpoint or (os.path.abspath(path) if path != "-" else None)
+    if checkpoint and restart:
+        db.clear_import_progress(checkpoint)
+    done = db.import_progress(checkpoint) if checkpoint else 0
+    if done:
+        click.echo(f"resuming after {done} users", err=True)
+
+    with _open(path, "r", fmt) as stream:
+        records = islice(_read_records(stream, fmt), done, None)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            try:
+                # decoded through the codec, handles older schema versions and base64 embeddings
+                db.add_users([from_record(dict(r, user_id=0)).as_dict for r in batch],
+                             progress=(checkpoint, done + len(batch)) if checkpoint else None)
+            except ValueError as e:
+                raise click.ClickException(f"invalid record after {done} imported users: {e}")
+            done += len(batch)
+            click.echo(f"\rimported {done} users", nl=False, err=True)
+    click.echo(f"\rimported {done} users", err=True)
+    if checkpoint:
+        db.clear_import_progress(checkpoint)
+
+
+@cli.command("export")
+@click.argument("path", type=click.Path(dir_okay=False, allow_dash=True), default="-")
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]), default=None,
+              help="File format, guessed from the extension by default.")
+@click.option("--batch-size", default=500, type=int, help="Users read per round-trip.")
+@click.option("--embeddings/--no-embeddings", default=False,
+              help="Include face/voice embeddings (base64).")
+@click.pass_obj
+def export_users(obj, path, fmt, batch_size, embeddings):
+    """Export all users to a JSONL or CSV file (stdout by default)."""
+    db: BaseUserDB = obj["db"]
+    fmt = _format(path, fmt)
+    n = 0
+    with _open(path, "w", fmt) as stream:
+        writer = None
+        if fmt == "csv":
+            writer = csv.DictWriter(stream, fieldnames=list(USER_FIELDS) + ["schema_version"])
+            writer.writeheader()
+        for user in db.iter_users(batch_size, with_embeddings=embeddings):
+            record = to_record(user)
+            if writer:
+                writer.writerow({k: v if k in _CSV_TEXT_FIELDS else json.dumps(v)
+                                 for k, v in record.items()})
+            else:
+                stream.write(json.dumps(record) + "\n")
+            n += 1
+            if n % batch_size == 0 and path != "-":
+                click.echo(f"\rexported {n} users", nl=False, err=True)
+    if path != "-":
+        click.echo(f"\rexported {n} users", err=True)
+
+
 if __name__ == "__main__":
     cli()
@@ -1,28 +1,122 @@
-from typing import Optional, Dict
+import hashlib
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Optional, Dict, Callable, List, Hashable, Any, Tuple, TYPE_CHECKING
 
 from ovos_bus_client.message import Message
 from ovos_bus_client.session import Session, SessionManager
+from ovos_config import Configuration
 from ovos_utils.log import LOG
 
-from ovos_plugin_manager.templates.embeddings import FaceEmbeddingsRecognizer, VoiceEmbeddingsRecognizer
+from ovos_user_id.cache import TTLCache
 from ovos_user_id.cam import CameraManager
-from ovos_user_id.db import UserDB
+from ovos_user_id.db import User, BaseUserDB, SESSION_FIELDS, user_db_from_config
+from ovos_user_id.metrics import METRICS, timed
 from ovos_user_id.mic import MicManager
+from ovos_user_id.redis_conn import get_redis
+from ovos_user_id.session_map import SessionUserMap, session_map_from_config
+
+if TYPE_CHECKING:
+    from ovos_plugin_manager.templates.embeddings import FaceEmbeddingsRecognizer, VoiceEmbeddingsRecognizer
+    from ovos_user_id.service import RecognitionClient
+
+
+class _LazyClassAttribute:
+    """class attribute created on first access instead of at import time,
+    assigning to the attribute on the class replaces it as usual"""
+
+    def __init__(self, factory: Callable):
+        self.factory = factory
+        self.lock = Lock()
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, obj, owner):
+        with self.lock:
+            value = owner.__dict__[self.name]
+            if value is self:  # not yet created
+                value = self.factory()
+                setattr(owner, self.name, value)
+        return value
+
+
+def _auth_executor() -> ThreadPoolExecutor:
+    """thread pool of UserManager.authenticate, each call runs up to 2 checks
+    (face and voice) so concurrent authentications need about twice as many
+    workers, set via "auth_workers" in the "user_db" config section"""
+    workers = Configuration().get("user_db", {}).get("auth_workers", 4)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="user-auth")
+
+
+# auth_level points contributed by each auth mechanism
+AUTH_POINTS = {"face": 30, "voice": 30, "auth_phrase": 15}
+
+
+def _content_hash(data) -> bytes:
+    """fingerprint of a frame/audio buffer (bytes or contiguous numpy array)"""
+    try:
+        return hashlib.blake2b(data, digest_size=16).digest()
+    except TypeError:  # not a contiguous buffer
+        return hashlib.blake2b(data.tobytes(), digest_size=16).digest()
+
+
+@dataclass
+class AuthResult:
+    user_id: int
+    auth_level: int = 0
+    factors: Dict[str, int] = field(default_factory=dict)  # mechanism -> points contributed
+    timings: Dict[str, float] = field(default_factory=dict)  # mechanism -> seconds taken
+    timed_out: List[str] = field(default_factory=list)  # mechanisms that missed the deadline
+    skipped: List[str] = field(default_factory=list)  # not waited for, required_level was reached
+    errors: Dict[str, str] = field(default_factory=dict)  # mechanisms that failed
+    elapsed: float = 0.0  # total seconds
+
+    def add(self, factor: str, points: int, took: float):
+        self.factors[factor] = points
+        self.timings[factor] = took
+        self.auth_level += points
+
+    def satisfies(self, required_level: Optional[int]) -> bool:
+        return required_level is not None and self.auth_level >= required_level
 
 
 class UserManager:
-    db: UserDB = UserDB()
-    face_recognizer: FaceEmbeddingsRecognizer = None
-    voice_recognizer: VoiceEmbeddingsRecognizer = None
-    sess2user: dict = {}
+    # created on first use, importing this module must not block on redis
+    db: BaseUserDB = _LazyClassAttribute(user_db_from_config)
+    face_recognizer: "FaceEmbeddingsRecognizer" = None
+    voice_recognizer: "VoiceEmbeddingsRecognizer" = None
+    # bounded session_id -> user_id bindings, optionally shared via redis
+    sess2user: SessionUserMap = _LazyClassAttribute(lambda: session_map_from_config(get_redis()))
+    # runs face and voice recognition concurrently in authenticate
+    executor: ThreadPoolExecutor = _LazyClassAttribute(_auth_executor)
+    auth_timeout: float = 0.8  # seconds, default deadline for authenticate
+    # recent predictions per (recognizer, frame/audio), repeated auth checks
+    # for the same interaction do not run the models again
+    prediction_cache: TTLCache = _LazyClassAttribute(
+        lambda: METRICS.register_cache("predictions", TTLCache(maxsize=256, ttl=2)))
+    _inflight: Dict[Hashable, Future] = {}  # predictions currently running
+    _inflight_lock = Lock()
+    recognition_client: Optional["RecognitionClient"] = None
 
     @classmethod
-    def bind(cls, face_rec: FaceEmbeddingsRecognizer,
-             voice_rec: VoiceEmbeddingsRecognizer):
-        # TODO - expose these via a bus api instead
-        # allow a dedicated service to run the plugins, avoiding multiple in memory plugins
+    def bind(cls, face_rec: "FaceEmbeddingsRecognizer",
+             voice_rec: "VoiceEmbeddingsRecognizer"):
+        """use recognizers loaded in this process, see also connect_service"""
         cls.face_recognizer = face_rec
         cls.voice_recognizer = voice_rec
+        cls.prediction_cache.clear()
+
+    @classmethod
+    def connect_service(cls, bus):
+        """use the recognition service (ovos-user-recognition) over the messagebus
+        for any recognizer not bound locally, models are then loaded once per host"""
+        from ovos_user_id.service import RecognitionClient
+        if cls.recognition_client is not None:
+            cls.recognition_client.shutdown()
+        cls.recognition_client = RecognitionClient(bus)
 
     @staticmethod
     def from_message(message: Message) -> Optional[dict]:
@@ -33,9 +127,25 @@ class UserManager:
         return UserManager.db.get_user(int(uid))
 
     @staticmethod
+    @timed
     def assign2session(user_id: int, session_id: str) -> Session:
-        user = (UserManager.db.get_user(user_id) or
+        # only the fields injected into the session are retrieved
+        user = (UserManager.db.get_user(user_id, fields=SESSION_FIELDS) or
                 UserManager.db.default_user)
+        return UserManager._apply_user(user, user_id, session_id)
+
+    @staticmethod
+    @timed
+    def _apply_user(user: User, user_id: int, session_id: str) -> Session:
+        """inject the user preferences into a session and bind it to user_id"""
+        sess = UserManager._inject_user(user, session_id)
+        UserManager.sess2user[sess.session_id] = user_id
+        LOG.debug(f"assigned user_id: {user_id} to session: {sess.session_id}")
+        return sess
+
+    @staticmethod
+    def _inject_user(user: User, session_id: str) -> Session:
+        """inject the user preferences into a session"""
         if session_id and session_id in SessionManager.sessions:
             sess = SessionManager.sessions[session_id]
         else:
@@ -60,39 +170,224 @@ class UserManager:
         sess.time_format = user["time_format"]
         sess.system_unit = user["system_unit"]
         SessionManager.update(sess)
-        UserManager.sess2user[sess.session_id] = user_id
-        LOG.debug(f"assigned user_id: {user_id} to session: {sess.session_id}")
         return sess
 
     @staticmethod
-    def authenticate(user_id, camera_id, auth_phrase: Optional[str] = None) -> int:
-        """skills should use this to get a auth level"""
-        auth_level = 0
+    def _predict(recognizer, content_id: Hashable,
+                 fetch: Callable[[], Tuple[Hashable, Any]]) -> Dict[str, float]:
+        """recognizer.predict(data, top_k=3), memoised per recognizer and content_id
 
-        user = UserManager.db.get_user(user_id)
-        if not user:
-            return 0
+        fetch() returns (content id, data), the content id differs from the
+        requested one if that content is gone and newer content was read instead,
+        the prediction is cached under the content it was made for
+
+        concurrent calls for the same content wait for a single prediction"""
+        key = (id(recognizer), content_id)
+        preds = UserManager.prediction_cache.get(key)
+        if preds is not None:
+            return preds
+        with UserManager._inflight_lock:
+            fut = UserManager._inflight.get(key)
+            running = fut is not None
+            if not running:
+                fut = UserManager._inflight[key] = Future()
+        if running:
+            return fut.result()
+        try:
+            fetched_id, data = fetch()
+            with METRICS.timer(type(recognizer).__name__ + ".predict"):
+                preds = recognizer.predict(data, top_k=3) or {}
+            UserManager.prediction_cache.put((id(recognizer), fetched_id), preds)
+            fut.set_result(preds)
+            return preds
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with UserManager._inflight_lock:
+                UserManager._inflight.pop(key, None)
 
-        # if face match increase auth level
+    @staticmethod
+    def _best_match(preds: Dict[str, float]) -> Optional[str]:
+        if not preds:
+            return None
+        uid, conf = max(preds.items(), key=lambda k: k[1])
+        return str(uid)
+
+    @staticmethod
+    def _face_input(camera_id) -> Optional[Tuple[Hashable, Callable[[], Tuple[Hashable, Any]]]]:
+        """(content id, frame getter) of the current camera frame, None if unavailable
+
+        the getter returns (content id, frame), see _predict"""
         cam = CameraManager.get(camera_id)
-        if cam and UserManager.face_recognizer:
-            frame = cam.get()
-            preds: Dict[str, float] = UserManager.face_recognizer.predict(frame, top_k=3)
-            uid, conf = max(preds.items(), key=lambda k: k[1])
-            if uid == user_id:
-                auth_level += 30
-
-        # if voice match increase auth level
-        mic = MicManager.get(camera_id)
-        if mic and UserManager.voice_recognizer:
-            frame = mic.get()
-            preds: Dict[str, float] = UserManager.voice_recognizer.predict(frame, top_k=3)
-            uid, conf = max(preds.items(), key=lambda k: k[1])
-            if uid == user_id:
-                auth_level += 30
+        if not cam:
+            return None
+        seq = cam.latest_seq()
+        if seq:
+            # streaming camera, the frame id identifies the content, no download on cache hits
+            def fetch():
+                # trimmed from the stream meanwhile, the newest frame replaces it
+                frame = cam.get_frame(seq) or cam.latest_frame()
+                if frame is None:
+                    raise LookupError(f"no frames in {cam.stream}")
+                return ("cam", camera_id, frame.seq), frame.image
+
+            return ("cam", camera_id, seq), fetch
+        image = cam.get()
+        if image is None:
+            return None
+        content_id = _content_hash(image)
+        return content_id, lambda: (content_id, image)
+
+    @staticmethod
+    def _voice_input(mic_id) -> Optional[Tuple[Hashable, Callable[[], Tuple[Hashable, Any]]]]:
+        """(content id, audio getter) of the last mic audio, None if unavailable"""
+        mic = MicManager.get(mic_id)
+        if not mic:
+            return None
+        audio = mic.get()
+        if not audio:
+            return None
+        content_id = _content_hash(audio)
+        return content_id, lambda: (content_id, audio)
+
+    @staticmethod
+    def _remaining(deadline: Optional[float]) -> Optional[float]:
+        """seconds left until a time.monotonic() deadline, None waits forever"""
+        return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+    @staticmethod
+    @timed
+    def _face_match(user_id, camera_id, deadline: Optional[float] = None) -> bool:
+        if not UserManager.face_recognizer:
+            # models are owned by the recognition service, no answer after the deadline is waited for
+            return UserManager.recognition_client.verify("face", camera_id, user_id,
+                                                         timeout=UserManager._remaining(deadline))
+        face = UserManager._face_input(camera_id)
+        if not face:
+            return False
+        preds = UserManager._predict(UserManager.face_recognizer, *face)
+        return UserManager._best_match(preds) == str(user_id)
+
+    @staticmethod
+    @timed
+    def _voice_match(user_id, mic_id, deadline: Optional[float] = None) -> bool:
+        if not UserManager.voice_recognizer:
+            # models are owned by the recognition service, no answer after the deadline is waited for
+            return UserManager.recognition_client.verify("voice", mic_id, user_id,
+                                                         timeout=UserManager._remaining(deadline))
+        voice = UserManager._voice_input(mic_id)
+        if not voice:
+            return False
+        preds = UserManager._predict(UserManager.voice_recognizer, *voice)
+        return UserManager._best_match(preds) == str(user_id)
+
+    @staticmethod
+    def _can_recognize(kind: str) -> bool:
+        """a local recognizer is bound or the recognition service provides one"""
+        if getattr(UserManager, kind + "_recognizer"):
+            return True
+        client = UserManager.recognition_client
+        return client is not None and client.available(kind)
 
+    @staticmethod
+    def _auth_checks(user_id, camera_id, mic_id: Optional[str], deadline: float,
+                     result: AuthResult, required_level: Optional[int]) -> Dict[str, Tuple[Callable, tuple]]:
+        """factor -> (check, args) of the recognizers worth running, none if
+        the auth phrase alone already reaches required_level"""
+        checks = {}
+        if UserManager._can_recognize("face"):
+            # if face match increase auth level
+            checks["face"] = (UserManager._face_match, (user_id, camera_id, deadline))
+        if UserManager._can_recognize("voice"):
+            # if voice match increase auth level
+            # NOTE: defaults to camera_id for backwards compatibility
+            checks["voice"] = (UserManager._voice_match, (user_id, mic_id or camera_id, deadline))
+        if result.satisfies(required_level):
+            result.skipped.extend(checks)
+            return {}
+        return checks
+
+    @staticmethod
+    def _add_check(result: AuthResult, factor: str, outcome: Callable[[], Tuple[bool, float]]):
+        """record the (matched, seconds taken) returned by outcome() in result"""
+        try:
+            matched, took = outcome()
+        except Exception as e:  # device missing, recognizer failure...
+            LOG.warning(f"{factor} authentication failed: {e}")
+            result.errors[factor] = str(e)
+            return
+        result.add(factor, AUTH_POINTS[factor] if matched else 0, took)
+
+    @staticmethod
+    def _timed_check(check: Callable, *args) -> Tuple[bool, float]:
+        """(check result, seconds taken), runs in UserManager.executor"""
+        t = time.monotonic()
+        return check(*args), time.monotonic() - t
+
+    @staticmethod
+    def _check_phrase(result: AuthResult, user: Optional[User], auth_phrase: Optional[str],
+                      start: float) -> bool:
+        """record a matching auth phrase in result, False if the user does not exist"""
+        if not user:
+            result.elapsed = time.monotonic() - start
+            return False
         # user secret phrase is known
         if auth_phrase and auth_phrase == user.get("auth_phrase"):
-            auth_level += 15
+            result.add("auth_phrase", AUTH_POINTS["auth_phrase"], time.monotonic() - start)
+        return True
 
-        return auth_level
+    @staticmethod
+    def _finish_auth(result: AuthResult, pending: Dict[Any, str],
+                     required_level: Optional[int], start: float) -> AuthResult:
+        """checks still pending (future -> factor) were not needed or did not make the deadline"""
+        # early exit, the remaining checks were not needed
+        unfinished = result.skipped if result.satisfies(required_level) else result.timed_out
+        for fut, factor in pending.items():
+            fut.cancel()  # no-op if already running, the result is ignored
+            unfinished.append(factor)
+        result.elapsed = time.monotonic() - start
+        return result
+
+    @staticmethod
+    @timed
+    def authenticate_detailed(user_id, camera_id, auth_phrase: Optional[str] = None,
+                              mic_id: Optional[str] = None,
+                              timeout: Optional[float] = None,
+                              required_level: Optional[int] = None) -> AuthResult:
+        """run every available auth mechanism and report what each one contributed
+
+        face and voice recognition run concurrently, whatever did not finish
+        within timeout seconds (default UserManager.auth_timeout) does not count,
+        if required_level is reached the remaining checks are not waited for"""
+        start = time.monotonic()
+        timeout = UserManager.auth_timeout if timeout is None else timeout
+        result = AuthResult(user_id=user_id)
+
+        user = UserManager.db.get_user(user_id, fields=("auth_phrase",))
+        if not UserManager._check_phrase(result, user, auth_phrase, start):
+            return result
+
+        deadline = start + timeout
+        checks = UserManager._auth_checks(user_id, camera_id, mic_id, deadline, result, required_level)
+        futures = {UserManager.executor.submit(UserManager._timed_check, check, *args): factor
+                   for factor, (check, args) in checks.items()}
+        pending = set(futures)
+        while pending and not result.satisfies(required_level):
+            done, pending = wait(pending, timeout=UserManager._remaining(deadline),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break  # deadline reached
+            for fut in done:
+                UserManager._add_check(result, futures[fut], fut.result)
+        return UserManager._finish_auth(result, {fut: futures[fut] for fut in pending},
+                                        required_level, start)
+
+    @staticmethod
+    def authenticate(user_id, camera_id, auth_phrase: Optional[str] = None,
+                     mic_id: Optional[str] = None,
+                     timeout: Optional[float] = None,
+                     required_level: Optional[int] = None) -> int:
+        """skills should use this to get a auth level, see authenticate_detailed"""
+        return UserManager.authenticate_detailed(user_id, camera_id, auth_phrase, mic_id,
+                                                 timeout, required_level).auth_level
@@ -15,7 +15,8 @@ setup(
     entry_points={
         'neon.plugin.metadata': METADATA_ENTRY_POINT,
         'console_scripts': [
-            'ovos-user-manager=ovos_user_id.tui:cli'
+            'ovos-user-manager=ovos_user_id.tui:cli',
+            'ovos-user-recognition=ovos_user_id.service:main'
         ]
     }
 )